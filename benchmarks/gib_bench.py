@@ -0,0 +1,183 @@
+#!/usr/bin/python
+
+# gib_bench.py
+# Times gib's commands against a synthetic source tree in a throwaway repro and
+# prints the results as JSON, so that runs (and branches) can be compared
+#
+# the tree is made from a seed, so the same options always give the same files.
+# each step is run as its own gib process and reports:
+#   wall_s        wall clock time
+#   subprocesses  git processes started (counted with GIT_TRACE2_EVENT)
+#   peak_rss_kb   peak RSS of gib and everything it ran
+#   repo_bytes    size of .git/objects afterwards
+#
+# usage: gib_bench.py [options], see --help
+
+from __future__ import print_function
+import os,sys,json,time,random,hashlib,shutil,tempfile,argparse,subprocess,platform
+
+gib=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','gib.py')
+
+def fileData(seed,path,size,version=0):
+    """ returns size bytes of content for a file, always the same for the same seed, path and version
+    the blocks are text with a lot of repetition, so they compress a bit like source files """
+    data=[]
+    for block in range(size//2049+1):
+        digest=hashlib.sha256(('%s:%s:%d:%d'%(seed,path,version,block)).encode('utf8')).hexdigest()
+        data.append((digest*32+'\n').encode('ascii'))
+    return b''.join(data)[:size]
+
+def makeTree(root,seed,files,depth,fanout,medianSize,sizeSpread,emptyDirRatio):
+    """ makes a source tree under root, returns the relative paths of its files
+    file sizes are log-normal around medianSize, emptyDirRatio of the dirs are left empty """
+    rng=random.Random(seed)
+    dirs=['']
+    level=['']
+    for n in range(depth):
+        level=[os.path.join(parent,'d%d_%d'%(n,i)) for parent in level for i in range(fanout)]
+        dirs+=level
+    os.makedirs(root)
+    for dir in dirs[1:]:
+        os.makedirs(os.path.join(root,dir))
+    empty=set(rng.sample(dirs[1:],int(len(dirs[1:])*emptyDirRatio)))
+    full=[dir for dir in dirs if dir not in empty]
+    paths=[]
+    for i in range(files):
+        path=os.path.join(rng.choice(full),'f%d.dat'%i)
+        size=int(rng.lognormvariate(0,sizeSpread)*medianSize)
+        writeFile(root,seed,path,size)
+        paths.append(path)
+    return paths
+
+def writeFile(root,seed,path,size,version=0):
+    f=open(os.path.join(root,path),'wb')
+    try:
+        f.write(fileData(seed,path,size,version))
+    finally:
+        f.close()
+
+def mutateTree(root,seed,paths,rate,medianSize,sizeSpread):
+    """ changes rate of the files in the tree: half are rewritten, a quarter deleted and a quarter replaced
+    by new files. returns the new list of paths """
+    rng=random.Random('%s:mutate'%seed)
+    paths=list(paths)
+    victims=rng.sample(range(len(paths)),int(len(paths)*rate))
+    added=[]
+    for (n,i) in enumerate(victims):
+        path=paths[i]
+        size=int(rng.lognormvariate(0,sizeSpread)*medianSize)
+        if n%4<2:
+            writeFile(root,seed,path,size,version=1)
+        else:
+            os.remove(os.path.join(root,path))
+            paths[i]=None
+            if n%4==3:
+                newPath=os.path.join(os.path.dirname(path),'new%d.dat'%i)
+                writeFile(root,seed,newPath,size)
+                added.append(newPath)
+    return [path for path in paths if path]+added
+
+def dirSize(path):
+    total=0
+    for (dir,subdirs,files) in os.walk(path):
+        total+=sum(os.lstat(os.path.join(dir,file)).st_size for file in files)
+    return total
+
+# runs a command and writes the peak RSS of it and its children to a file. a process starts with the
+# peak RSS of the one that forked it, so gib is started from this small one rather than from the benchmark
+measure='''import sys,subprocess,resource
+status=subprocess.call(sys.argv[2:])
+open(sys.argv[1],'w').write(str(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))
+sys.exit(status)'''
+
+def runGib(python,repo,args):
+    """ runs a gib command in repo, returns its measurements """
+    (fd,trace)=tempfile.mkstemp(prefix='gib_bench_trace.')
+    os.close(fd)
+    (fd,rss)=tempfile.mkstemp(prefix='gib_bench_rss.')
+    os.close(fd)
+    env=dict(os.environ)
+    env['GIT_TRACE2_EVENT']=trace
+    devnull=open(os.devnull,'wb')
+    start=time.time()
+    status=subprocess.call([python,'-c',measure,rss,python,gib]+args,cwd=repo,env=env,stdout=devnull)
+    wall=time.time()-start
+    devnull.close()
+    if status!=0:
+        sys.exit('gib %s failed in %s'%(' '.join(args),repo))
+    with open(trace) as f:
+        subprocesses=sum(1 for line in f if '"event":"start"' in line)
+    os.remove(trace)
+    with open(rss) as f:
+        peak=int(f.read())
+    os.remove(rss)
+    return {'wall_s':round(wall,4),'subprocesses':subprocesses,
+        'peak_rss_kb':peak,'repo_bytes':dirSize(os.path.join(repo,'.git','objects'))}
+
+def snapshotNames(repo,backup):
+    refs=subprocess.check_output(['git','for-each-ref','--format=%(refname)','refs/gib/%s/snapshots/'%backup],cwd=repo)
+    return [ref.split('/')[-1] for ref in refs.decode('utf8').split()]
+
+def main():
+    parser=argparse.ArgumentParser(description='Benchmarks gib against a generated source tree, printing JSON')
+    parser.add_argument('--files',type=int,default=2000,help='number of files (default 2000)')
+    parser.add_argument('--depth',type=int,default=3,help='levels of dirs (default 3)')
+    parser.add_argument('--fanout',type=int,default=4,help='subdirs in each dir (default 4)')
+    parser.add_argument('--median-size',type=int,default=4096,help='median file size in bytes (default 4096)')
+    parser.add_argument('--size-spread',type=float,default=1.5,help='sigma of the log-normal file sizes (default 1.5)')
+    parser.add_argument('--empty-dirs',type=float,default=0.1,help='fraction of dirs left empty (default 0.1)')
+    parser.add_argument('--mutate',type=float,default=0.05,help='fraction of files changed before the warm snapshot (default 0.05)')
+    parser.add_argument('--seed',default='gib',help='seed for the tree, the same seed gives the same tree')
+    parser.add_argument('--jobs',type=int,default=1,help='--jobs for snapshot and extract (default 1)')
+    parser.add_argument('--snapshot-args',default='',help='extra options for snapshot, eg. "--index"')
+    parser.add_argument('--python',default=sys.executable,help='python to run gib with (default this one)')
+    parser.add_argument('--output',help='write the JSON here instead of to stdout')
+    parser.add_argument('--keep',action='store_true',help="don't delete the tree and repro afterwards")
+    opts=parser.parse_args()
+
+    work=tempfile.mkdtemp(prefix='gib_bench.')
+    try:
+        src=os.path.join(work,'src')
+        repo=os.path.join(work,'repo')
+        subprocess.check_call(['git','init','-q',repo])
+        start=time.time()
+        paths=makeTree(src,opts.seed,opts.files,opts.depth,opts.fanout,opts.median_size,opts.size_spread,opts.empty_dirs)
+        generated=time.time()-start
+        jobs=['--jobs',str(opts.jobs)]
+        extra=jobs+opts.snapshot_args.split()
+        results={}
+        results['snapshot_cold']=runGib(opts.python,repo,['snapshot']+extra+['bench',src])
+        results['snapshot_unchanged']=runGib(opts.python,repo,['snapshot']+extra+['bench',src])
+        mutateTree(src,opts.seed,paths,opts.mutate,opts.median_size,opts.size_spread)
+        # snapshot names are timestamps, make sure the next one gets a new one
+        time.sleep(1)
+        results['snapshot_warm']=runGib(opts.python,repo,['snapshot']+extra+['bench',src])
+        results['list']=runGib(opts.python,repo,['list','bench'])
+        snapshots=snapshotNames(repo,'bench')
+        results['extract']=runGib(opts.python,repo,['extract']+jobs+['bench',snapshots[-1],os.path.join(work,'out')])
+        results['delete']=runGib(opts.python,repo,['delete','bench',snapshots[0]])
+        report={
+            'tree':{'files':opts.files,'depth':opts.depth,'fanout':opts.fanout,'median_size':opts.median_size,
+                'size_spread':opts.size_spread,'empty_dirs':opts.empty_dirs,'mutate':opts.mutate,'seed':opts.seed,
+                'bytes':dirSize(src),'generate_s':round(generated,4)},
+            'jobs':opts.jobs,
+            'snapshot_args':opts.snapshot_args,
+            'git':subprocess.check_output(['git','version']).decode('utf8').strip(),
+            'python':subprocess.check_output([opts.python,'-c','import platform; print(platform.python_version())']).decode('utf8').strip(),
+            'platform':platform.platform(),
+            'results':results,
+        }
+        text=json.dumps(report,indent=2,sort_keys=True)
+        if opts.output:
+            with open(opts.output,'w') as f:
+                f.write(text+'\n')
+        else:
+            print(text)
+    finally:
+        if opts.keep:
+            sys.stderr.write('kept %s\n'%work)
+        else:
+            shutil.rmtree(work)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+#!/usr/bin/python
+
+# pbs_resolve.py
+# Measures how long pbs takes to turn a program name into a Command, with and
+# without the resolve cache (without it, every lookup scans the whole PATH,
+# which is what pbs always did before the cache)
+#
+# usage: pbs_resolve.py [program] [iterations]
+
+import os,sys,timeit
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import pbs
+
+def main():
+    program=sys.argv[1] if len(sys.argv)>1 else 'git'
+    iterations=int(sys.argv[2]) if len(sys.argv)>2 else 10000
+    lookup=lambda : getattr(pbs,program)
+    lookup()
+
+    def uncached():
+        pbs.clear_resolve_cache()
+        lookup()
+
+    cachedTime=min(timeit.repeat(lookup,number=iterations,repeat=3))
+    uncachedTime=min(timeit.repeat(uncached,number=iterations,repeat=3))
+    print('PATH has %d entries'%len(os.environ.get('PATH','').split(os.pathsep)))
+    print('uncached: %8.2f us per lookup of %s'%(uncachedTime*1e6/iterations,program))
+    print('cached:   %8.2f us per lookup of %s'%(cachedTime*1e6/iterations,program))
+
+if __name__ == "__main__":
+    main()
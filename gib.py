@@ -28,104 +28,1279 @@
 #===============================================================================
 
 import pbs
-import sys,os,datetime
+import gitstore
+import sys,os,stat,time,datetime,hashlib,binascii,getopt,threading,fnmatch,zlib,fcntl,tempfile,shutil,json,random,math
+import multiprocessing,re,socket,urllib,cgi,mimetypes,BaseHTTPServer,Queue
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from os import scandir
+except ImportError:
+    # python 2 only has this as a separate package, fall back to listdir/lstat without it
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir=None
 
 # set this to specify the dir dir should be somewhere other than the current directory
 gitdir='.git'
+# whether objects and refs are read in this process where they can be (see gitstore), rather than always by git
+useStore=True
+
+def git(*args,**kwargs):
+    return pbs.git('--git-dir=%s'%gitdir,*args,**kwargs)
+
+def git_pipe(input,*args,**kwargs):
+    return pbs.git(input,'--git-dir=%s'%gitdir,*args,**kwargs)
+
+def gibDir(backupname):
+    """ returns the dir where gib keeps its private state for a backup """
+    return os.path.join(gitdir,'gib',backupname)
+
+def indexEnv(indexfile):
+    """ returns an environment that makes git use indexfile instead of the shared index """
+    dir=os.path.dirname(indexfile)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    env=dict(os.environ)
+    # git changes into the work tree before it reads this, so it must be absolute
+    env['GIT_INDEX_FILE']=os.path.abspath(indexfile)
+    return env
+
+# the lock files held by this gib command, they are kept open until it exits
+locks={}
+
+def takeLock(path,inUse):
+    """ takes the lock file at path for the rest of this gib command, or fails with the message inUse if another
+    gib command has it. the OS drops the lock when the command exits, however it exits """
+    if path in locks:
+        return
+    dir=os.path.dirname(path)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    f=open(path,'a')
+    try:
+        fcntl.flock(f,fcntl.LOCK_EX|fcntl.LOCK_NB)
+    except IOError:
+        f.close()
+        fatal(inUse)
+    locks[path]=f
+
+def lockBackup(backupname):
+    """ takes the lock on a backup, so only one gib command at a time can change its snapshots and
+    private state """
+    takeLock(os.path.join(gibDir(backupname),'lock'),"Backup '%s' is in use by another gib command"%backupname)
+
+def pathIndexEnv(backupname,path):
+    """ returns an environment for the private index of one source path of a backup
+    the index is kept between snapshots, so git's stat cache means only changed files are re-hashed """
+    key=hashlib.sha1(os.path.abspath(path)).hexdigest()
+    return indexEnv(os.path.join(gibDir(backupname),'indexes',key))
+
+class CatFile(object):
+    """ reads objects out of the repro, in this process with gitstore where it can, otherwise with a
+    'git cat-file --batch' kept running, which is only started when it is first needed """
+    def __init__(self):
+        self.store=gitstore.ObjectStore(gitdir) if useStore and gitstore.supported(gitdir) else None
+        self.proc=None
+
+    def open(self,sha,store=True):
+        """ returns (type,size,blocks) for an object, blocks being a generator for its contents that has to be
+        read to the end, or None if the repro doesn't have it. store=False always asks git """
+        if store and self.store:
+            try:
+                found=self.store.open(sha)
+                if found:
+                    return found
+            except gitstore.Unsupported:
+                pass
+        if self.proc is None:
+            self.proc=git('cat-file','--batch',_coproc=True)
+        header=self.proc.request(sha).split()
+        if header[-1]=='missing':
+            return None
+        return (header[1],int(header[2]),self.blocks(int(header[2])))
+
+    def blocks(self,size,blocksize=1024*1024):
+        """ generator func for the contents of the object cat-file is sending, a block at a time """
+        try:
+            while size:
+                block=self.proc.read(min(size,blocksize))
+                size-=len(block)
+                yield block
+        finally:
+            # if whoever wanted it stopped early, the rest still has to be read past
+            while size:
+                size-=len(self.proc.read(min(size,blocksize)))
+            self.proc.read(1)
+
+    def read(self,sha):
+        """ returns (type,data) for an object, or None if the repro doesn't have it """
+        for store in (True,False):
+            found=self.open(sha,store)
+            if not found:
+                return None
+            try:
+                return (found[0],''.join(found[2]))
+            except gitstore.Unsupported:
+                # damaged part way through, see what git makes of it
+                continue
+
+    def copy(self,sha,out):
+        """ writes the contents of a blob to the file object out a block at a time """
+        found=self.open(sha)
+        if not found or found[0]!='blob':
+            fatal('Blob %s is missing from the repro'%sha)
+        try:
+            for block in found[2]:
+                out.write(block)
+        except gitstore.Unsupported,e:
+            fatal('Blob %s is damaged in the repro: %s'%(sha,e))
+
+    def hash(self,sha):
+        """ returns (type,size,sha) for an object, the sha being worked out again from what is in the repro,
+        or None if the repro doesn't have it. the object is read a block at a time """
+        for store in (True,False):
+            found=self.open(sha,store)
+            if not found:
+                return None
+            h=hashlib.sha1('%s %d\0'%(found[0],found[1]))
+            try:
+                for block in found[2]:
+                    h.update(block)
+            except gitstore.Unsupported:
+                continue
+            return (found[0],found[1],h.hexdigest())
+
+    def size(self,sha):
+        """ returns the size of an object, or None if the repro doesn't have it """
+        if self.store:
+            try:
+                found=self.store.info(sha)
+                if found:
+                    return found[1]
+            except gitstore.Unsupported:
+                pass
+        return helper(CheckObjects).size(sha)
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.close()
+        if self.store:
+            self.store.close()
+
+    def kill(self):
+        if self.proc is not None:
+            self.proc.kill()
+        if self.store:
+            self.store.close()
+
+class HashObjects(object):
+    """ a 'git hash-object -w --stdin-paths' kept running to import files into the repro
+    if write is False the files are only hashed, nothing is added to the repro """
+    def __init__(self,write=True):
+        self.proc=git('hash-object',*(['-w'] if write else [])+['--no-filters','--stdin-paths'],_coproc=True)
+
+    def hash(self,path):
+        """ imports a file (following symlinks) and returns its blob sha """
+        return self.proc.request(path)
+
+    def close(self):
+        self.proc.close()
+
+    def kill(self):
+        self.proc.kill()
+
+class IndexInfo(object):
+    """ a 'git update-index --index-info' kept running to feed entries into an index
+    git holds the index lock until this is closed """
+    def __init__(self,indexfile):
+        self.proc=git('update-index','-z','--index-info',_env=indexEnv(indexfile),_coproc=True)
+
+    def add(self,mode,sha,path):
+        self.proc.write('%s %s\t%s\0'%(mode,sha,path))
+
+    def remove(self,path):
+        self.proc.write('0 %s\t%s\0'%('0'*40,path))
+
+    def close(self):
+        self.proc.close()
+
+    def kill(self):
+        self.proc.kill()
 
-def git(*args):
-    return pbs.git('--git-dir=%s'%gitdir,*args)
+class CheckObjects(object):
+    """ a 'git cat-file --batch-check' kept running to see which objects are already in the repro """
+    def __init__(self):
+        self.proc=git('cat-file','--batch-check',_coproc=True)
 
-def git_pipe(input,*args):
-    return pbs.git(input,'--git-dir=%s'%gitdir,*args)
+    def exists(self,sha):
+        return not self.proc.request(sha).endswith(' missing')
 
-def clearIndex():
-    index=git('ls-files')
-    if index.strip()!='':
-        git('rm','--cached','-rf','.')
+    def size(self,sha):
+        """ returns the size of an object, or None if the repro doesn't have it """
+        header=self.proc.request(sha).split()
+        return None if header[-1]=='missing' else int(header[2])
 
-def getEmptyDirs(path):
-    """ generator func to list all the empty dirs in a dir """
-    for (dirpath,dirnames,filenames) in os.walk(path):
-        if len(filenames)==0 and len(dirnames)==0:
-            yield dirpath
+    def close(self):
+        self.proc.close()
 
-def makeTreeFromDir(backupname,paths):
-    """ imports a path into the git repro and makes a tree from it. returns the tree sha """
-    clearIndex()
+    def kill(self):
+        self.proc.kill()
+
+class FastImport(object):
+    """ a 'git fast-import' kept running to write blobs into the repro
+    they go straight into a pack, which is only finished when this is closed """
+    def __init__(self):
+        self.proc=git('fast-import','--quiet',_coproc=True)
+
+    def add(self,data):
+        self.proc.write('blob\ndata %d\n'%len(data))
+        self.proc.write(data)
+        self.proc.write('\n')
+
+    def close(self):
+        self.proc.close()
+
+    def kill(self):
+        self.proc.kill()
+
+# helper processes that have been started, they are kept for the whole gib command
+helpers={}
+
+def helper(cls,*args):
+    """ returns a running helper of the given class, starting one if there isn't one yet
+    each thread gets its own, as they can only deal with one request at a time """
+    key=(cls,args,threading.current_thread().ident)
+    if key not in helpers:
+        helpers[key]=cls(*args)
+    return helpers[key]
+
+def dropHelper(cls,*args):
+    """ forgets this thread's helper of class cls after it has died, so helper() starts a new one """
+    helpers.pop((cls,args,threading.current_thread().ident),None)
+
+class WorkerExit(Exception):
+    """ carries a SystemExit (from fatal) or other BaseException out of a pool thread. the pool only passes
+    on Exceptions, with anything else it would wait for the task forever """
+    def __init__(self,exit):
+        Exception.__init__(self,exit)
+        self.exit=exit
+
+def inParallel(fn,items,jobs,chunksize=1):
+    """ calls fn for each of items from a pool of jobs threads, or from this thread if jobs is 1 """
+    if jobs==1:
+        for item in items:
+            fn(item)
+        return
+    def call(item):
+        try:
+            return fn(item)
+        except Exception:
+            raise
+        except BaseException,e:
+            raise WorkerExit(e)
+    pool=ThreadPool(jobs)
+    try:
+        pool.map(call,items,chunksize)
+    except WorkerExit,e:
+        raise e.exit
+    finally:
+        pool.close()
+        pool.join()
+
+def closeHelpers(failed=False,cls=None):
+    """ shuts down the helpers (or just those of class cls), checking they ended ok. if the command failed
+    they are just stopped """
+    for key in [key for key in helpers if cls in (None,key[0])]:
+        running=helpers.pop(key)
+        if failed:
+            running.kill()
+        else:
+            running.close()
+
+def fileKind(mode):
+    """ returns 'dir', 'file' or 'link' for a st_mode, or None for things git can't store """
+    if stat.S_ISDIR(mode):
+        return 'dir'
+    if stat.S_ISREG(mode):
+        return 'file'
+    if stat.S_ISLNK(mode):
+        return 'link'
+    return None
+
+def listDir(path):
+    """ returns (name,kind,st) for each entry in a dir, kind is as for fileKind. symlinks to dirs are links
+    st is the entry's lstat if it had to be done to find the kind, otherwise None """
+    if scandir:
+        listing=[]
+        for entry in scandir(path):
+            if entry.is_symlink():
+                kind='link'
+            elif entry.is_dir(follow_symlinks=False):
+                kind='dir'
+            elif entry.is_file(follow_symlinks=False):
+                kind='file'
+            else:
+                kind=None
+            listing.append((entry.name,kind,None))
+        return listing
+    listing=[]
+    for name in os.listdir(path):
+        st=os.lstat(os.path.join(path,name))
+        listing.append((name,fileKind(st.st_mode),st))
+    return listing
+
+def scanTree(path):
+    """ generator func that walks a dir once, yielding (relpath,isEmptyDir) for every file and
+    every empty dir in it. git's own .git dirs and things git can't store are skipped, just as 'git add' would """
+    stack=['']
+    while stack:
+        rel=stack.pop()
+        entries=listDir(os.path.join(path,rel))
+        if not entries:
+            yield (rel,True)
+        for (name,kind,st) in entries:
+            if name=='.git' or not kind:
+                continue
+            if kind=='dir':
+                stack.append(os.path.join(rel,name))
+            else:
+                yield (os.path.join(rel,name),False)
+
+def checkBackupPaths(paths):
+    """ checks the paths given to snapshot can be backed up, returns (path,name in snapshot) for each """
     topLevel=[]
-    filesInTree=[]
-    dirsInTree=[]
-    emptyFileHash=None
     for path in paths:
         if not os.path.exists(path):
             fatal("Path '%s' does not exist, cannot backup"%path)
-        bn=os.path.basename(path)
-        if bn in topLevel:
+        bn=os.path.basename(os.path.normpath(path))
+        if bn in [name for (p,name) in topLevel]:
             fatal("Multiple paths ending in '%s' are being backed up, not supported"%bn)
+        topLevel.append((path,bn))
+    return topLevel
+
+def makeTreeFromDir(backupname,paths,lastTree=None,useIndex=False,jobs=1,chunkThreshold=None,stdinName=None):
+    """ imports a path into the git repro and makes a tree from it. returns the tree sha
+    lastTree is the tree of the last snapshot, which lets unchanged files and dirs be reused
+    jobs is how many files can be hashed at once (the index builder always hashes one at a time)
+    files of chunkThreshold bytes or more are stored in chunks (the index builder can't do this)
+    if stdinName is given, stdin is stored as a file of that name at the top level too (not by the index
+    builder either, as it may be chunked) """
+    if useIndex:
+        return makeTreeWithIndex(backupname,paths)
+    return makeTreeWithMktree(backupname,paths,lastTree,jobs,chunkThreshold,stdinName)
+
+def makeTreeWithIndex(backupname,paths):
+    """ makes the snapshot tree by adding the paths to private git indexes """
+    filesInTree=[]
+    dirsInTree=[]
+    emptyFileHash=None
+    for (path,bn) in checkBackupPaths(paths):
         if os.path.isdir(path):
-            # add current dir to the index (also import all objects)
-            git('--work-tree',path,'add','-f','.')
-            # empty dirs are not added by the above, pretend there is a .gibkeep file in each
-            # (we will delete this when extracting backups)
-            for emptyDir in getEmptyDirs(path):
-                if not emptyFileHash:
-                    emptyFileHash=git_pipe(pbs.echo('-n',''),'hash-object','-w','--stdin').strip()
-                git('update-index','--add','--cacheinfo','10644',emptyFileHash,os.path.join(os.path.relpath(emptyDir,path),'.gibkeep'))
+            env=pathIndexEnv(backupname,path)
+            files=[]
+            keeps=[]
+            for (rel,isEmptyDir) in scanTree(path):
+                if isEmptyDir:
+                    # empty dirs can't go in a tree, pretend there is a .gibkeep file in each
+                    # (we will delete this when extracting backups)
+                    keeps.append(os.path.join(rel,'.gibkeep'))
+                else:
+                    files.append(rel)
+            # anything left in the private index from the last snapshot that is no longer there is dropped
+            # with a mode 0 entry (this includes .gibkeeps of dirs that filled up and files now dirs)
+            seen=set(files)
+            seen.update(keeps)
+            gone=[file for file in str(git('ls-files','-z',_env=env)).split('\0') if file and file not in seen]
+            if keeps and not emptyFileHash:
+                emptyFileHash=str(git('hash-object','-w','--stdin',_in='')).strip()
+            if gone or keeps:
+                info=IndexInfo(env['GIT_INDEX_FILE'])
+                for file in gone:
+                    info.remove(file)
+                for keep in keeps:
+                    info.add('100644',emptyFileHash,keep)
+                info.close()
+            # bring the private index up to date with the files (also import all objects), only files
+            # whose stat data changed since the last snapshot get re-hashed
+            git('--work-tree',path,'update-index','--add','--replace','-z','--stdin',
+                _env=env,_in=(file+'\0' for file in files))
             # write the tree for this and get the tree sha
-            tree=git('write-tree').strip()
-            clearIndex()
+            tree=git('write-tree',_env=env).strip()
             dirsInTree.append((bn,tree))
         else:
             fileHash=git('hash-object','-w',path).strip()
             filesInTree.append((bn,fileHash))
-    clearIndex()
-    # now make the final snapshot index
-    for (dir,tree) in dirsInTree:
-        git('read-tree','-i',tree,'--prefix=%s/'%dir)
-    for (file,hash) in filesInTree:
-        # see http://git-scm.com/book/en/Git-Internals-Git-Objects
-        # adding with 10644 means normal file (TODO perhaps check if it should be marked as executable)
-        # cacheinfo means we have the hash, but no file in our work dir corresponding to it
-        git('update-index','--add','--cacheinfo','10644',hash,file)
-    tree=git('write-tree').strip()
-    clearIndex()
+    # now make the final snapshot index, in a temporary index of this command's own so the shared one
+    # (and any other gib command) is left alone
+    tmpdir=tempfile.mkdtemp(prefix='index.',dir=gibDir(backupname))
+    try:
+        env=indexEnv(os.path.join(tmpdir,'index'))
+        git('read-tree','--empty',_env=env)
+        for (dir,tree) in dirsInTree:
+            git('read-tree','-i',tree,'--prefix=%s/'%dir,_env=env)
+        for (file,hash) in filesInTree:
+            # see http://git-scm.com/book/en/Git-Internals-Git-Objects
+            # adding with 10644 means normal file (TODO perhaps check if it should be marked as executable)
+            # cacheinfo means we have the hash, but no file in our work dir corresponding to it
+            git('update-index','--add','--cacheinfo','10644',hash,file,_env=env)
+        tree=git('write-tree',_env=env).strip()
+    finally:
+        shutil.rmtree(tmpdir)
+    return tree
+
+# the sha of an empty blob, this is what the .gibkeep files in empty dirs contain
+emptyBlob='e69de29bb2d1d6434b8b29ae775ad8c2e48c5391'
+
+def loadManifest(backupname,lastTree):
+    """ returns the stat manifest recorded when the tree lastTree was made, or an empty manifest if
+    there isn't one that can be trusted (ie. it wasn't made for the last snapshot) """
+    manifest={'tree':None,'time':0,'files':{},'chunked':{},'dirs':{}}
+    try:
+        f=open(os.path.join(gibDir(backupname),'manifest'),'rb')
+    except IOError:
+        return manifest
+    try:
+        loaded=pickle.load(f)
+    except Exception:
+        return manifest
+    finally:
+        f.close()
+    if lastTree and loaded.get('tree')==lastTree:
+        # manifests from before files were chunked don't have any
+        loaded.setdefault('chunked',{})
+        return loaded
+    return manifest
+
+def saveManifest(backupname,manifest):
+    dir=gibDir(backupname)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    tmp=os.path.join(dir,'manifest.tmp')
+    f=open(tmp,'wb')
+    try:
+        pickle.dump(manifest,f,pickle.HIGHEST_PROTOCOL)
+    finally:
+        f.close()
+    os.rename(tmp,os.path.join(dir,'manifest'))
+
+def statSignature(st):
+    """ the stat data that says whether a file has changed since it was last hashed """
+    return (st.st_mode,st.st_size,st.st_mtime,st.st_ctime,st.st_ino)
+
+def fileEntry(name,path,key,st,mode,old,new,toHash,chunkThreshold=None):
+    """ returns the [name,mode,sha,subentries] entry for a file. sha comes from the old manifest if the file
+    hasn't changed, otherwise it is None and the file is added to toHash as (entry,path,size)
+    files of chunkThreshold bytes or more are stored as a tree of chunks, see chunkFile """
+    if chunkThreshold and mode!='120000' and st.st_size>=chunkThreshold:
+        entry=[name,'40000',None,[['.gibchunks',mode,None,None]]]
+        files='chunked'
+    else:
+        entry=[name,mode,None,None]
+        files='files'
+    signature=statSignature(st)
+    known=old[files].get(key)
+    # files modified in the same second as the last scan started might have changed again without
+    # their mtime changing, so they always get re-hashed
+    if known and known[0]==signature and int(st.st_mtime)<int(old['time']):
+        entry[2]=known[1]
+        # the chunks are only needed if the tree is being made again
+        entry[3]=None
+    else:
+        toHash.append((entry,path,st.st_size))
+    new[files][key]=(signature,entry)
+    return entry
+
+def scanDirForTree(path,key,old,new,toHash,chunkThreshold=None):
+    """ walks a dir for makeTreeWithMktree, returning the entries of its tree as [name,mode,sha,subentries]
+    lists. sha is None for dirs, and for files that need hashing (see fileEntry). subentries is None for
+    chunked files that haven't changed. returns None if there is nothing in the dir git can store """
+    listing=listDir(path)
+    if not listing:
+        # empty dirs can't go in a tree, pretend there is a .gibkeep file in each
+        # (we will delete this when extracting backups)
+        return [['.gibkeep','100644',emptyBlob,None]]
+    entries=[]
+    for (name,kind,st) in listing:
+        if name=='.git' or not kind:
+            continue
+        full=os.path.join(path,name)
+        subkey=key+'/'+name
+        if kind=='dir':
+            sub=scanDirForTree(full,subkey,old,new,toHash,chunkThreshold)
+            if sub is not None:
+                entries.append([name,'40000',None,sub])
+            continue
+        st=st or os.lstat(full)
+        if kind=='link':
+            mode='120000'
+        else:
+            mode='100755' if st.st_mode&stat.S_IXUSR else '100644'
+        entries.append(fileEntry(name,full,subkey,st,mode,old,new,toHash,chunkThreshold))
+    return entries if entries else None
+
+def hashLink(entry,path,write=True):
+    # a symlink is stored as a blob holding where it points
+    entry[2]=storeBlob(os.readlink(path),write)
+
+def hashBatch(batch,write=True):
+    """ hashes a list of (entry,path) files with this thread's git process, filling in the entry shas """
+    hasher=helper(HashObjects,write)
+    for (entry,path) in batch:
+        entry[2]=hasher.hash(path)
+
+def hashFiles(toHash,jobs=1,write=True):
+    """ writes the contents of the (entry,path,size) files into the repro, filling in the entry shas
+    the work is spread over jobs git processes, which are given roughly the same number of bytes each
+    if write is False the shas are worked out without adding anything to the repro """
+    links=[]
+    chunked=[]
+    batches=[[] for i in range(jobs)]
+    sizes=[0]*jobs
+    for (entry,path,size) in sorted(toHash,key=lambda tup : tup[2],reverse=True):
+        if entry[1]=='120000':
+            links.append((entry,path))
+        elif entry[1]=='40000':
+            chunked.append((entry,path))
+        elif '\n' in path:
+            # --stdin-paths can't cope with these
+            entry[2]=str(git('hash-object',*(['-w'] if write else [])+['--no-filters','--',path])).strip()
+        else:
+            smallest=sizes.index(min(sizes))
+            batches[smallest].append((entry,path))
+            sizes[smallest]+=size
+    # the hashing happens in the git processes, so threads are enough to keep them all busy
+    inParallel(lambda batch : hashBatch(batch,write),[batch for batch in batches if batch],jobs)
+    # these are hashed here, they only need a blob written through this thread's fast-import
+    for (entry,path) in links:
+        hashLink(entry,path,write)
+    inParallel(lambda file : chunkFile(file[0],file[1],write),chunked,jobs)
+    # the chunks have to be in the repro before mktree looks for them
+    closeHelpers(cls=FastImport)
+
+# files are cut into chunks of at least chunkMin bytes and at most chunkMax, with cuts coming on average
+# chunkExtra bytes after chunkMin. chunkWindow bytes at the end of a line decide if it is cut there
+chunkMin=1024*1024
+chunkMax=8*1024*1024
+chunkExtra=128*1024
+chunkWindow=64
+
+def findCut(data):
+    """ returns where the first chunk of data ends. cuts are made at line ends, each one being picked with a
+    chance in proportion to the length of its line, using a crc of the end of the line. so the cuts only depend
+    on the content around them, and an edit only changes the chunks near it. data without line ends is cut
+    every chunkMax bytes """
+    if len(data)<=chunkMin:
+        return len(data)
+    # a byte at a time rolling hash would be far too slow in python, finding line ends isn't
+    lineStart=data.rfind('\n',0,chunkMin)+1
+    pos=chunkMin
+    while True:
+        end=data.find('\n',pos,chunkMax)
+        if end<0:
+            return min(len(data),chunkMax)
+        end+=1
+        if zlib.crc32(data[max(lineStart,end-chunkWindow):end])&0xffffffff<(end-lineStart)*(2**32/chunkExtra):
+            return end
+        lineStart=pos=end
+
+def fileChunks(f,data=''):
+    """ generator func that reads a file object and yields it in chunks, see findCut
+    data is anything that has already been read from the start of the file """
+    while True:
+        while len(data)<chunkMax:
+            more=f.read(chunkMax)
+            if not more:
+                break
+            data+=more
+        if not data:
+            return
+        cut=findCut(data)
+        yield data[:cut]
+        data=data[cut:]
+
+def storeBlob(data,write=True):
+    """ returns the sha of a blob holding data, adding it to the repro if write is set and it isn't there already """
+    hash=hashlib.sha1('blob %d\0'%len(data))
+    hash.update(data)
+    sha=hash.hexdigest()
+    if write and not helper(CheckObjects).exists(sha):
+        helper(FastImport).add(data)
+    return sha
+
+def chunkFile(entry,path,write=True):
+    """ fills in the entries of the tree for a chunked file from fileEntry. it holds a .gibchunks marker with the
+    mode of the file, then a blob for each chunk named by its number. only chunks that aren't in the repro
+    already are written, so a big file that changes a little only adds a few chunks each snapshot """
+    f=open(path,'rb')
+    try:
+        chunkStream(entry,f,write)
+    finally:
+        f.close()
+
+def chunkStream(entry,f,write=True,data=''):
+    """ fills in the entries of a chunked file's tree as chunkFile does, from a file object
+    data is anything that has already been read from the start of it """
+    size=0
+    for chunk in fileChunks(f,data):
+        entry[3].append(['%08d'%(len(entry[3])-1),'100644',storeBlob(chunk,write),None])
+        size+=len(chunk)
+    entry[3][0][2]=storeBlob('gibchunks 1\nsize %d\n'%size,write)
+
+# stdin is chunked if there is at least this much of it and no --chunk-threshold was given. git hash-object
+# reads all of its stdin into memory, so stdin is never given to it whole
+stdinChunkThreshold=16*1024*1024
+
+def stdinEntry(name,chunkThreshold=None):
+    """ returns the [name,mode,sha,subentries] entry for a file made from whatever comes in on stdin
+    it is chunked as chunkFile does if there are at least chunkThreshold (or stdinChunkThreshold) bytes
+    of it, so at most that much of it is held in memory """
+    chunkThreshold=chunkThreshold or stdinChunkThreshold
+    start=sys.stdin.read(chunkThreshold)
+    if len(start)<chunkThreshold:
+        return [name,'100644',str(git('hash-object','-w','--stdin',_in=start)).strip(),None]
+    entry=[name,'40000',None,[['.gibchunks','100644',None,None]]]
+    chunkStream(entry,sys.stdin,True,start)
+    return entry
+
+def treeSha(entries):
+    """ works out the sha git will give a tree, entries must all have their shas """
+    # git sorts the entries for dirs as if they ended in /
+    entries.sort(key=lambda e : e[0]+'/' if e[1]=='40000' else e[0])
+    data=''.join('%s %s\0%s'%(mode,name,binascii.unhexlify(sha)) for (name,mode,sha,sub) in entries)
+    return hashlib.sha1('tree %d\0%s'%(len(data),data)).hexdigest()
+
+def resolveTree(entries,key,old,new,toWrite):
+    """ fills in the shas of the subdirs of a tree, bottom up, and returns its sha
+    trees that aren't the same as in the last snapshot are added to toWrite """
+    for entry in entries:
+        if entry[1]=='40000' and entry[3] is not None:
+            entry[2]=resolveTree(entry[3],key+'/'+entry[0],old,new,toWrite)
+    sha=treeSha(entries)
+    new['dirs'][key]=sha
+    if old['dirs'].get(key)!=sha:
+        toWrite.append((sha,entries))
+    return sha
+
+def writeTrees(toWrite):
+    """ writes the (sha,entries) trees in a single mktree, children must come before their parents """
+    if not toWrite:
+        return
+    input=[]
+    for (sha,entries) in toWrite:
+        for (name,mode,entrySha,sub) in entries:
+            input.append('%s %s %s\t%s\0'%(mode,'tree' if mode=='40000' else 'blob',entrySha,name))
+        input.append('\0')
+    written=str(git('mktree','-z','--batch',_in=input)).split()
+    if written!=[sha for (sha,entries) in toWrite]:
+        fatal('Internal error, git wrote different trees to the ones expected')
+
+def scanPathsForTree(paths,old,new,toHash,chunkThreshold=None):
+    """ scans the paths given to snapshot as scanDirForTree does, returning the entries of the root tree """
+    root=[]
+    for (path,bn) in checkBackupPaths(paths):
+        if os.path.isdir(path):
+            entries=scanDirForTree(path,bn,old,new,toHash,chunkThreshold)
+            if entries is not None:
+                root.append([bn,'40000',None,entries])
+        else:
+            # files at the top level are stored as normal files whatever they are, as they always have been
+            root.append(fileEntry(bn,path,bn,os.stat(path),'100644',old,new,toHash,chunkThreshold))
+    return root
+
+def makeTreeWithMktree(backupname,paths,lastTree,jobs=1,chunkThreshold=None,stdinName=None):
+    """ makes the snapshot tree bottom up without an index. a stat manifest is kept with the backup, so
+    files that haven't changed since the last snapshot aren't hashed and dirs that haven't changed
+    reuse the tree from the last snapshot. changed files are hashed by jobs git processes at once """
+    old=loadManifest(backupname,lastTree)
+    new={'tree':None,'time':time.time(),'files':{},'chunked':{},'dirs':{}}
+    toHash=[]
+    root=scanPathsForTree(paths,old,new,toHash,chunkThreshold)
+    if stdinName:
+        # there's nothing to stat, so this is always read
+        root.append(stdinEntry(stdinName,chunkThreshold))
+    hashFiles(toHash,jobs)
+    toWrite=[]
+    tree=resolveTree(root,'',old,new,toWrite)
+    if any(sha==emptyBlob for (treeSha,entries) in toWrite for (name,mode,sha,sub) in entries):
+        # make sure the .gibkeep contents are in the repro before mktree checks for them
+        git('hash-object','-w','--stdin',_in='')
+    writeTrees(toWrite)
+    # only the shas are needed next time
+    for files in ('files','chunked'):
+        for (key,(signature,entry)) in new[files].items():
+            new[files][key]=(signature,entry[2])
+    new['tree']=tree
+    saveManifest(backupname,new)
     return tree
 
 def getLatestSnapshot(backupname):
     """ returns the (sha,refname) pair for the last snapshot. returns None if there is no last snapshot """
-    allRefs=getAllRefs()
-    snapshots=[]
-    for (ref,sha) in allRefs.items():
-        if ref.startswith('refs/gib/%s/snapshots/'%backupname):
-            snapshots.append((sha,ref))
-    snapshots.sort(key=lambda tup : tup[1],reverse=True)
+    # the snapshot names are timestamps, so the last one by name is the latest
+    snapshots=list(getRefs('refs/gib/%s/snapshots/'%backupname,count=1,newestFirst=True))
     return snapshots[0] if len(snapshots)>0 else None
 
+def getOptions(args,longopts):
+    """ pulls the --options out of a command's args, returns (dict of options,remaining args) """
+    try:
+        (opts,rest)=getopt.gnu_getopt(args,'',longopts)
+    except getopt.GetoptError,e:
+        fatal(str(e))
+    return (dict(opts),rest)
+
+def getJobs(opts):
+    """ returns the number of parallel jobs asked for with --jobs """
+    try:
+        jobs=int(opts.get('--jobs',1))
+    except ValueError:
+        jobs=0
+    if jobs<1:
+        fatal('--jobs must be a number greater than 0')
+    return jobs
+
+def getSize(opts,option,default=None):
+    """ returns the size in bytes given with an option, which can end in K, M or G, or default if it wasn't given """
+    if option not in opts:
+        return default
+    size=opts[option].upper()
+    scale=1
+    if size[-1:] in ('K','M','G'):
+        scale=1024**('KMG'.index(size[-1])+1)
+        size=size[:-1]
+    try:
+        value=int(size)*scale
+    except ValueError:
+        value=0
+    if value<1:
+        fatal('%s must be a size greater than 0, eg. 64M'%option)
+    return value
+
+def getChunkThreshold(opts):
+    """ returns the size in bytes given with --chunk-threshold, or None if files aren't to be chunked """
+    return getSize(opts,'--chunk-threshold')
+
+# snapshot commits are made by gib rather than by a person, so they get gib's own identity
+commitEnv=dict(os.environ,GIT_AUTHOR_NAME='gib',GIT_AUTHOR_EMAIL='gib@localhost',
+    GIT_COMMITTER_NAME='gib',GIT_COMMITTER_EMAIL='gib@localhost')
+
 def snapshot(args):
-    if len(args)<2:
+    (opts,args)=getOptions(args,['index','jobs=','commit','chunk-threshold=','stdin='])
+    stdinName=opts.get('--stdin')
+    if len(args)<(1 if stdinName else 2):
         fatal('Wrong number of parameters for snapshot command')
     backupname=args[0]
     backuppaths=args[1:]
+    if stdinName is not None and (not stdinName or '/' in stdinName or stdinName in ('.','..')):
+        fatal('--stdin needs a file name to store the data as')
+    if stdinName in [bn for (path,bn) in checkBackupPaths(backuppaths)]:
+        fatal("Multiple paths ending in '%s' are being backed up, not supported"%stdinName)
+    lockBackup(backupname)
+    jobs=getJobs(opts)
+    chunkThreshold=getChunkThreshold(opts)
+    if chunkThreshold and '--index' in opts:
+        fatal('--chunk-threshold can\'t be used with --index')
+    if stdinName and '--index' in opts:
+        fatal('--stdin can\'t be used with --index')
     last=getLatestSnapshot(backupname)
-    tree=makeTreeFromDir(backupname,backuppaths)
-    if not last or tree!=last[0]:
-        ref='refs/gib/%s/snapshots/%s'%(backupname,datetime.datetime.now().strftime('%Y%m%d_%H%M%S'))
-        git('update-ref',ref,tree)
-        print 'Made snapshot %s = %s'%(ref,tree)
+    lastTree=None
+    lastCommit=None
+    if last:
+        # the last snapshot is either a bare tree or a commit wrapping one
+        lastTree=getRef(last[0]+'^{tree}')
+        if lastTree!=last[0]:
+            lastCommit=last[0]
+    tree=makeTreeFromDir(backupname,backuppaths,lastTree,'--index' in opts,jobs,chunkThreshold,stdinName)
+    if not last or tree!=lastTree:
+        timestamp=datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        if last and last[1].endswith('/'+timestamp):
+            # the last snapshot was made this second, snapshots are never replaced so wait for the next
+            time.sleep(1-time.time()%1)
+            timestamp=datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        ref='refs/gib/%s/snapshots/%s'%(backupname,timestamp)
+        sha=tree
+        # once a backup is a chain of commits it stays one, so fetch and push can negotiate with it
+        if '--commit' in opts or lastCommit:
+            parents=['-p',lastCommit] if lastCommit else []
+            sha=git('commit-tree',tree,'-m','gib snapshot %s %s'%(backupname,timestamp),*parents,_env=commitEnv).strip()
+        # the empty old value makes git refuse to change the ref if something else has made it
+        git('update-ref','-m','gib snapshot',ref,sha,'')
+        print 'Made snapshot %s = %s'%(ref,sha)
     else:
         print "Didn't make snapshot, no changes since last snapshot on %s"%(last[1])
 
+def snapshotAllWorker(backup):
+    """ runs a snapshot command in a snapshot-all worker process, returns whether it worked and the git
+    commands it traced """
+    (backupname,args)=backup
+    # the git commands traced here are passed back, this process's copy of the list started with the parent's
+    del traced[:]
+    try:
+        try:
+            snapshot(args)
+        finally:
+            sys.stdout.flush()
+    except SystemExit:
+        # fatal has already said why
+        closeHelpers(True)
+        return (False,traced)
+    except Exception,e:
+        print 'Snapshot of %s failed: %s'%(backupname,e)
+        sys.stdout.flush()
+        closeHelpers(True)
+        return (False,traced)
+    closeHelpers()
+    return (True,traced)
+
+def readSnapshotConfig(configfile):
+    """ returns (backupname,snapshot command args) for each backup in a snapshot-all config file, which has a section
+    for each backup:
+        [backupname]
+        paths = /var/www/blog
+                /tmp/blog.sql
+        jobs = 4
+        commit = yes
+        chunk-threshold = 64M
+        index = no
+    only paths is needed. they are one per line, relative paths are relative to the git repro """
+    config=RawConfigParser()
+    try:
+        if not config.read(configfile):
+            fatal("Can't read config file '%s'"%configfile)
+    except Exception,e:
+        fatal("Can't read config file '%s': %s"%(configfile,e))
+    backups=[]
+    for backupname in config.sections():
+        args=[]
+        for option in config.options(backupname):
+            value=config.get(backupname,option)
+            if option in ('jobs','chunk-threshold'):
+                args+=['--'+option,value]
+            elif option in ('commit','index'):
+                if config.getboolean(backupname,option):
+                    args.append('--'+option)
+            elif option!='paths':
+                fatal("Unknown setting '%s' for backup '%s' in %s"%(option,backupname,configfile))
+        paths=[path.strip() for path in config.get(backupname,'paths').splitlines() if path.strip()] \
+            if config.has_option(backupname,'paths') else []
+        if not paths:
+            fatal("No paths given for backup '%s' in %s"%(backupname,configfile))
+        backups.append((backupname,args+[backupname]+paths))
+    return backups
+
+def snapshotAll(args):
+    (opts,args)=getOptions(args,['jobs='])
+    if len(args)!=1:
+        fatal('Wrong number of arguments for snapshot-all command')
+    backups=readSnapshotConfig(args[0])
+    jobs=getJobs(opts) if '--jobs' in opts else min(multiprocessing.cpu_count(),len(backups))
+    # each snapshot gets a fresh process, so they don't share any helpers or other state
+    pool=multiprocessing.Pool(max(jobs,1),maxtasksperchild=1)
+    try:
+        results=pool.map(snapshotAllWorker,backups,1)
+    finally:
+        pool.close()
+        pool.join()
+    worked=[ok for (ok,records) in results]
+    for (ok,records) in results:
+        traced.extend(records)
+    failed=[backupname for ((backupname,backupArgs),ok) in zip(backups,worked) if not ok]
+    if failed:
+        fatal('Snapshots of %s failed'%', '.join(failed))
+
+def gitVersion():
+    """ returns the version of git as a tuple of ints, eg. (2,39,5) """
+    version=str(git('version')).split()[2]
+    return tuple(int(part) for part in version.split('.') if part.isdigit())
+
+def hasCommitSnapshots():
+    """ returns whether any snapshot is a commit (made with snapshot --commit) """
+    for x in git('for-each-ref','--format=%(objecttype)','refs/gib/',_iter=True):
+        if x.strip()=='commit':
+            return True
+    return False
+
+def countObjects():
+    """ returns git's count-objects -v numbers as a dict """
+    return dict((key,int(value)) for (key,value) in
+        (line.split(': ') for line in str(git('count-objects','-v')).splitlines()) if value.isdigit())
+
+def maintain(args):
+    (opts,args)=getOptions(args,['time-budget=','prune-expire=','no-prune'])
+    if len(args)!=0:
+        fatal('Wrong number of arguments for maintain command')
+    try:
+        budget=float(opts.get('--time-budget',0))
+    except ValueError:
+        budget=-1
+    if budget<0:
+        fatal('--time-budget must be a number of seconds')
+    takeLock(os.path.join(gitdir,'gib','maintain.lock'),'Another gib maintain is already running')
+    start=time.time()
+    before=countObjects()
+    steps=[]
+    if gitVersion()>=(2,34):
+        # geometric repacking packs the loose objects and only merges packs that are small compared to the
+        # ones after them, so the big old packs are hardly ever rewritten. the bitmap goes in the
+        # multi-pack-index, so it covers every pack without them all being rolled into one
+        steps.append(('packing loose objects and small packs',
+            ['repack','-d','-l','-q','--geometric=2','--write-midx','--write-bitmap-index']))
+    else:
+        steps.append(('packing loose objects',['repack','-d','-l','-q']))
+        steps.append(('writing the multi-pack-index',['multi-pack-index','write']))
+    if hasCommitSnapshots():
+        # split commit-graphs are added to a layer at a time, like the packs
+        steps.append(('writing the commit-graph',['commit-graph','write','--reachable','--split','--size-multiple=2']))
+    if '--no-prune' not in opts:
+        # the grace period stops objects a snapshot running right now has written, but not yet made a ref
+        # for, from being thrown away
+        steps.append(('pruning unreachable loose objects',
+            ['prune','--expire=%s'%opts.get('--prune-expire','2.weeks.ago')]))
+    for (i,(what,command)) in enumerate(steps):
+        if budget and time.time()-start>=budget:
+            print 'Out of time, skipped %s'%', '.join(what for (what,command) in steps[i:])
+            break
+        stepStart=time.time()
+        git(*command)
+        print '%s took %.1fs'%(what[0].upper()+what[1:],time.time()-stepStart)
+    after=countObjects()
+    print 'Loose objects %d -> %d, packs %d -> %d, %.1fs in all'%(before.get('count',0),after.get('count',0),
+        before.get('packs',0),after.get('packs',0),time.time()-start)
+
+def status(args):
+    (opts,args)=getOptions(args,['jobs=','chunk-threshold='])
+    if len(args)<2:
+        fatal('Wrong number of parameters for status command')
+    backupname=args[0]
+    backuppaths=args[1:]
+    jobs=getJobs(opts)
+    chunkThreshold=getChunkThreshold(opts)
+    last=getLatestSnapshot(backupname)
+    lastTree=getRef(last[0]+'^{tree}') if last else None
+    old=loadManifest(backupname,lastTree)
+    toHash=[]
+    new={'tree':None,'time':time.time(),'files':{},'chunked':{},'dirs':{}}
+    root=scanPathsForTree(backuppaths,old,new,toHash,chunkThreshold)
+    if lastTree:
+        # only the files the manifest can't vouch for get hashed, and nothing is added to the repro
+        hashFiles(toHash,jobs,write=False)
+        if resolveTree(root,'',old,{'dirs':{}},[])==lastTree:
+            print 'No changes since last snapshot on %s'%(last[1])
+            return
+    else:
+        print 'There are no snapshots of %s yet, everything is new'%backupname
+    for (change,path,o,n) in compareTrees(helper(CatFile),lastTree,root):
+        print change,path
+
+def getSample(opts):
+    """ returns the percentage of blobs asked for with --sample, eg. 10% """
+    try:
+        sample=float(opts.get('--sample','100').rstrip('%'))
+    except ValueError:
+        sample=0
+    if not 0<sample<=100:
+        fatal('--sample must be a percentage, more than 0 and at most 100')
+    return sample
+
+def checkObject(catfile,sha,kind,where,problems):
+    """ re-hashes an object, returning its size, or adding what is wrong with it to problems and returning None """
+    try:
+        found=catfile.hash(sha)
+    except pbs.ErrorReturnCode,e:
+        # git couldn't inflate it, the next object gets a new cat-file
+        dropHelper(CatFile)
+        problems.append('Unreadable %s %s (%s): %s'%(kind,sha,where,(e.stderr or '').strip()))
+        return None
+    if not found:
+        problems.append('Missing %s %s (%s)'%(kind,sha,where))
+    elif found[0]!=kind:
+        problems.append('%s %s (%s) is a %s'%(kind.capitalize(),sha,where,found[0]))
+    elif found[2]!=sha:
+        problems.append('Corrupt %s %s (%s), its contents hash to %s'%(kind,sha,where,found[2]))
+    else:
+        return found[1]
+    return None
+
+def verifySnapshots(backupname,snapshots,jobs,sample):
+    """ re-hashes the objects of the (name,sha) snapshots, all of their trees and sample percent of their blobs
+    returns what is wrong, as messages """
+    catfile=helper(CatFile)
+    problems=[]
+    trees=[]
+    for (name,sha) in snapshots:
+        obj=catfile.read(sha)
+        if obj and obj[0]=='commit':
+            if checkObject(catfile,sha,'commit',name,problems) is None:
+                continue
+            sha=obj[1].split('\n',1)[0].split()[1]
+        trees.append((sha,name+'/'))
+    # the trees have to be read to find what is in them, blobs are only noted here
+    seen=set()
+    blobs={}
+    while trees:
+        (sha,where)=trees.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+        if checkObject(catfile,sha,'tree',where,problems) is None:
+            continue
+        for (name,mode,entrySha) in readTree(catfile,sha):
+            if mode=='40000':
+                trees.append((entrySha,where+name+'/'))
+            elif mode in ('100644','100755','120000'):
+                blobs.setdefault(entrySha,where+name)
+    toCheck=sorted(blobs)
+    if sample<100:
+        toCheck=random.sample(toCheck,int(math.ceil(len(toCheck)*sample/100)))
+    sizes=[]
+    inParallel(lambda sha : sizes.append(checkObject(helper(CatFile),sha,'blob',blobs[sha],problems)),toCheck,jobs,chunksize=64)
+    print 'Checked %d trees and %d of %d blobs (%d bytes) in %d snapshots of %s'%(len(seen),len(toCheck),len(blobs),
+        sum(size for size in sizes if size),len(snapshots),backupname)
+    return problems
+
+def verifyLive(backupname,snapshotname,tree,paths,jobs,chunkThreshold):
+    """ hashes paths as a snapshot of them would, and compares that with tree. returns the differences """
+    # an empty manifest, so every file is read
+    old={'tree':None,'time':0,'files':{},'chunked':{},'dirs':{}}
+    toHash=[]
+    new={'tree':None,'time':time.time(),'files':{},'chunked':{},'dirs':{}}
+    root=scanPathsForTree(paths,old,new,toHash,chunkThreshold)
+    hashFiles(toHash,jobs,write=False)
+    if resolveTree(root,'',old,{'dirs':{}},[])==tree:
+        print 'Snapshot %s of %s matches %s'%(snapshotname,backupname,' '.join(paths))
+        return []
+    # A is only in the live files, D only in the snapshot
+    return ['%s %s'%(change,path) for (change,path,o,n) in compareTrees(helper(CatFile),tree,root)]
+
+def verify(args):
+    (opts,args)=getOptions(args,['jobs=','sample=','live','chunk-threshold='])
+    live='--live' in opts
+    if len(args)<(3 if live else 1) or (not live and len(args)>2):
+        fatal('Wrong number of arguments for verify command')
+    backupname=args[0]
+    jobs=getJobs(opts)
+    if live:
+        if '--sample' in opts:
+            fatal('--sample is only for checking the repro, not with --live')
+        snapshotname=args[1]
+        tree=getSnapshotTree(backupname,snapshotname)
+        if not tree:
+            snapshotMissing(backupname,snapshotname)
+        problems=verifyLive(backupname,snapshotname,tree,args[2:],jobs,getChunkThreshold(opts))
+    else:
+        if '--chunk-threshold' in opts:
+            fatal('--chunk-threshold is only for --live')
+        prefix='refs/gib/%s/snapshots/'%backupname
+        snapshots=[(ref[len(prefix):],sha) for (sha,ref) in getRefs(prefix) if len(args)==1 or ref[len(prefix):]==args[1]]
+        if not snapshots:
+            if len(args)==2:
+                snapshotMissing(backupname,args[1])
+            fatal('There are no snapshots of %s'%backupname)
+        problems=verifySnapshots(backupname,snapshots,jobs,getSample(opts))
+    for problem in problems:
+        print problem
+    if problems:
+        fatal('%d problems found'%len(problems) if not live else '%d differences found'%len(problems))
+    if not live:
+        print 'All OK'
+
+def entrySize(catfile,entry):
+    """ returns the size of the file for a tree entry from compareTrees, chunked files included """
+    if entry[1]=='40000':
+        # the marker of a chunked file, gibchunks 1\nsize N\n
+        marker=catfile.read(readTree(catfile,entry[2])[0][2])
+        return int(marker[1].splitlines()[1].split()[1])
+    return catfile.size(entry[2]) or 0
+
+def diff(args):
+    (opts,args)=getOptions(args,['stat','renames'])
+    if len(args)!=3:
+        fatal('Wrong number of arguments for diff command')
+    (backupname,snapshotA,snapshotB)=args
+    trees=[]
+    for snapshotname in (snapshotA,snapshotB):
+        tree=getSnapshotTree(backupname,snapshotname)
+        if not tree:
+            snapshotMissing(backupname,snapshotname)
+        trees.append(tree)
+    catfile=helper(CatFile)
+    showStat='--stat' in opts
+    totals={'A':[0,0],'M':[0,0],'D':[0,0],'R':[0,0]}
+    # with --renames, added and deleted files are held back until the end to be paired up
+    added={}
+    deleted={}
+    def show(change,path,size,text=None):
+        totals[change][0]+=1
+        totals[change][1]+=size
+        if not showStat:
+            print '%s %12s %s'%(change,text or size,path)
+            sys.stdout.flush()
+    for (change,path,o,n) in compareTrees(catfile,trees[0],trees[1]):
+        if path.endswith('/'):
+            # an empty dir
+            if not showStat:
+                print '%s %12s %s'%(change,'-',path)
+            continue
+        if change=='M':
+            (oldSize,newSize)=(entrySize(catfile,o),entrySize(catfile,n))
+            show('M',path,newSize-oldSize,'%d->%d'%(oldSize,newSize))
+        elif '--renames' in opts and (o or n)[2]!=emptyBlob:
+            (added if change=='A' else deleted).setdefault((o or n)[2],[]).append((path,o or n))
+        else:
+            show(change,path,entrySize(catfile,o or n))
+    # a file deleted in one place and added with the same contents in another was moved
+    for sha in sorted(set(added)|set(deleted),key=lambda sha : (deleted.get(sha) or added.get(sha))[0][0]):
+        (fromFiles,toFiles)=(deleted.get(sha,[]),added.get(sha,[]))
+        size=entrySize(catfile,(fromFiles+toFiles)[0][1])
+        for ((fromPath,o),(toPath,n)) in zip(fromFiles,toFiles):
+            show('R','%s -> %s'%(fromPath,toPath),size)
+        for (path,o) in fromFiles[len(toFiles):]:
+            show('D',path,size)
+        for (path,n) in toFiles[len(fromFiles):]:
+            show('A',path,size)
+    if showStat:
+        print '%d added (%d bytes), %d modified (%+d bytes), %d deleted (%d bytes)%s'%(totals['A'][0],totals['A'][1],
+            totals['M'][0],totals['M'][1],totals['D'][0],totals['D'][1],
+            ', %d renamed (%d bytes)'%tuple(totals['R']) if '--renames' in opts else '')
+
 def delete_():
     if len(sys.argv)!=4:
         fatal('Wrong number of arguments for delete command')
+    lockBackup(sys.argv[2])
     ref='refs/gib/%s/snapshots/%s'%(sys.argv[2],sys.argv[3])
-    allRefs=getAllRefs()
-    if ref in allRefs:
-        git('update-ref','-d',ref)
+    sha=getRef(ref)
+    if sha:
+        if commitSnapshots([(sha,sys.argv[3])]):
+            fatal("%s/snapshots/%s was made with --commit, the snapshots after it keep it reachable so deleting it "
+                "wouldn't free any space. prune --rewrite-commits can drop it"%(sys.argv[2],sys.argv[3]))
+        git('update-ref','-d',ref,sha)
     else:
         print 'Ref "%s" does not exist'%ref
 
+def commitSnapshots(snapshots):
+    """ returns the set of names of the (sha,snapshotname) snapshots that are commits (made with --commit) """
+    catfile=helper(CatFile)
+    return set(name for (sha,name) in snapshots if (catfile.read(sha) or ('missing',))[0]=='commit')
+
+def rewriteCommitChain(catfile,kept,write=True):
+    """ returns (snapshotname,old sha,new sha) for the kept (sha,snapshotname) commit snapshots, oldest first,
+    that have to be made again so that each one's parent is the kept one before it. the others are left out of
+    the chain, so only the kept snapshots are reachable from it. the new commits have the same trees, messages,
+    authors and dates as the old ones. without write nothing is made and the new shas are None """
+    rewritten=[]
+    parent=None
+    for (sha,name) in sorted(kept,key=lambda snapshot : snapshot[1]):
+        (headers,message)=catfile.read(sha)[1].split('\n\n',1)
+        fields=[line.split(' ',1) for line in headers.splitlines()]
+        parents=[value for (field,value) in fields if field=='parent']
+        if parents==([parent] if parent else []):
+            parent=sha
+            continue
+        env=dict(os.environ)
+        for (field,value) in fields:
+            match=re.match(r'^(.*) <(.*)> (\d+ [-+]\d{4})$',value)
+            if field in ('author','committer') and match:
+                for (part,text) in zip(('NAME','EMAIL','DATE'),match.groups()):
+                    env['GIT_%s_%s'%(field.upper(),part)]=text
+        tree=[value for (field,value) in fields if field=='tree'][0]
+        new=str(git('commit-tree',tree,*(['-p',parent] if parent else []),_in=message,_env=env)).strip() if write else None
+        rewritten.append((name,sha,new))
+        # without write, whatever the new commit would have been can't be the parent of any already there
+        parent=new or 'new'
+    return rewritten
+
+def snapshotTime(snapshotname):
+    """ returns the datetime a snapshot was made from its name, or None if it isn't a timestamp """
+    try:
+        return datetime.datetime.strptime(snapshotname,'%Y%m%d_%H%M%S')
+    except ValueError:
+        return None
+
+def snapshotsToKeep(snapshotnames,daily=0,weekly=0,monthly=0):
+    """ returns the set of snapshot names a retention policy keeps: the newest snapshot of each of the last
+    daily days, weekly (ISO) weeks and monthly months that have snapshots. the newest snapshot and any
+    whose names aren't timestamps are always kept """
+    dated=[]
+    keep=set()
+    for name in snapshotnames:
+        when=snapshotTime(name)
+        if when:
+            dated.append((when,name))
+        else:
+            keep.add(name)
+    dated.sort(reverse=True)
+    keep.update(name for (when,name) in dated[:1])
+    for (count,period) in ((daily,lambda when : when.date()),
+                           (weekly,lambda when : when.isocalendar()[:2]),
+                           (monthly,lambda when : (when.year,when.month))):
+        periods=set()
+        for (when,name) in dated:
+            if period(when) in periods:
+                continue
+            if len(periods)>=count:
+                break
+            periods.add(period(when))
+            keep.add(name)
+    return keep
+
+def getCount(opts,option):
+    """ returns the number given with an option, 0 if it wasn't given """
+    try:
+        count=int(opts.get(option,0))
+    except ValueError:
+        count=-1
+    if count<0:
+        fatal('%s must be a number, 0 or more'%option)
+    return count
+
+def prune(args):
+    (opts,args)=getOptions(args,['keep-daily=','keep-weekly=','keep-monthly=','dry-run','rewrite-commits'])
+    if len(args)!=1:
+        fatal('Wrong number of arguments for prune command')
+    backupname=args[0]
+    (daily,weekly,monthly)=[getCount(opts,option) for option in ('--keep-daily','--keep-weekly','--keep-monthly')]
+    if not (daily or weekly or monthly):
+        fatal('Give at least one of --keep-daily, --keep-weekly or --keep-monthly')
+    dryRun='--dry-run' in opts
+    if not dryRun:
+        lockBackup(backupname)
+    prefix='refs/gib/%s/snapshots/'%backupname
+    snapshots=[(sha,ref[len(prefix):]) for (sha,ref) in getRefs(prefix)]
+    keep=snapshotsToKeep([name for (sha,name) in snapshots],daily,weekly,monthly)
+    victims=[(sha,name) for (sha,name) in snapshots if name not in keep]
+    # commit snapshots keep the ones before them reachable, so dropping their refs alone frees nothing
+    commits=commitSnapshots(snapshots)
+    rewritten=[]
+    if '--rewrite-commits' in opts:
+        rewritten=rewriteCommitChain(helper(CatFile),[(sha,name) for (sha,name) in snapshots
+            if name in commits and name in keep],not dryRun)
+    else:
+        skipped=[name for (sha,name) in victims if name in commits]
+        victims=[(sha,name) for (sha,name) in victims if name not in commits]
+        for name in skipped:
+            print 'Skipping %s/snapshots/%s, it was made with --commit'%(backupname,name)
+        if skipped:
+            print 'Snapshots made with --commit stay reachable from the ones after them, --rewrite-commits drops them'
+    for (sha,name) in victims:
+        print '%s %s/snapshots/%s'%('Would delete' if dryRun else 'Deleting',backupname,name)
+    for (name,sha,new) in rewritten:
+        print '%s %s/snapshots/%s'%('Would rewrite' if dryRun else 'Rewriting',backupname,name)
+    if (victims or rewritten) and not dryRun:
+        # one transaction, so either all of them change or (if any changed under us) none do
+        git('update-ref','--stdin',_in=['delete %s%s %s\n'%(prefix,name,sha) for (sha,name) in victims]+
+            ['update %s%s %s %s\n'%(prefix,name,new,sha) for (name,sha,new) in rewritten])
+    print '%s %d snapshots of %s, kept %d'%('Would delete' if dryRun else 'Deleted',len(victims),backupname,
+        len(snapshots)-len(victims))
+
 def list_():
     if len(sys.argv)!=2 and len(sys.argv)!=3:
         fatal('Wrong number of arguments for list command')
@@ -134,13 +1309,37 @@ def list_():
         startwith='refs/gib/'
     else:
         startwith='refs/gib/%s/'%sys.argv[2]
-    allRefs=getAllRefs()
-    toPrint=[]
-    for (ref,sha) in allRefs.items():
-        if ref.startswith(startwith):
-            toPrint.append(ref[9:])
-    toPrint.sort()
-    print '\n'.join(toPrint)
+    for (sha,ref) in getRefs(startwith):
+        print ref[9:]
+
+def getRemoteRefs(startswith):
+    """ returns a dict of sha keyed by ref name for the refs on origin starting with startswith """
+    remoteRefs={}
+    # git (and the remote, with protocol v2) only has to look at the gib refs
+    for x in git('ls-remote','origin','refs/gib/*',_iter=True):
+        (sha,ref)=x.split()
+        if ref.startswith(startswith):
+            remoteRefs[ref]=sha
+    return remoteRefs
+
+def snapshotPrefix(args):
+    """ returns the ref prefix picked out by an optional backupname and snapshotname """
+    startswith='refs/gib/'
+    if len(args)>=1:
+        startswith+=args[0]
+    if len(args)>=2:
+        startswith+='/snapshots/'+args[1]
+    return startswith
+
+# how many refspecs are put on one git command line, to stay well inside the OS limit
+refspecsPerCommand=1000
+
+def transfer(command,refs):
+    """ fetches or pushes refs (to the same names) from/to origin in as few git commands as possible
+    git's own progress output goes straight to the terminal """
+    refspecs=['%s:%s'%(ref,ref) for ref in sorted(refs)]
+    for start in range(0,len(refspecs),refspecsPerCommand):
+        git(command,'origin',*refspecs[start:start+refspecsPerCommand],_out=sys.stdout,_err=sys.stderr)
 
 def listremote():
     if len(sys.argv)!=2 and len(sys.argv)!=3:
@@ -148,61 +1347,616 @@ def listremote():
     startswith='refs/gib/'
     if len(sys.argv)==3:
         startswith+=sys.argv[2]
-    for x in str(git('ls-remote','origin')).splitlines():
-        (has,ref)=x.split()
-        if ref.startswith(startswith):
-            print ref[9:]
+    for ref in sorted(getRemoteRefs(startswith)):
+        print ref[9:]
 
 def fetch():
     if len(sys.argv)!=2 and len(sys.argv)!=3 and len(sys.argv)!=4:
         fatal('Wrong number of arguments for fetch command')
-    startswith='refs/gib/'
-    if len(sys.argv)>=3:
-        startswith+=sys.argv[2]
-    if len(sys.argv)>=4:
-        startswith+='/snapshots/'+sys.argv[3]
-    for x in str(git('ls-remote','origin')).splitlines():
-        (has,ref)=x.split()
-        if ref.startswith(startswith):
-            os.system('git --git-dir=%s fetch origin %s:%s'%(gitdir,ref,ref))
+    startswith=snapshotPrefix(sys.argv[2:])
+    remoteRefs=getRemoteRefs(startswith)
+    localRefs=dict((ref,sha) for (sha,ref) in getRefs('refs/gib/'))
+    # snapshots never change, so any we already have can be left out
+    wanted=[ref for (ref,sha) in remoteRefs.items() if localRefs.get(ref)!=sha]
+    print 'Fetching %d snapshots from origin (%d already here)'%(len(wanted),len(remoteRefs)-len(wanted))
+    if wanted:
+        transfer('fetch',wanted)
+
+def push():
+    if len(sys.argv)!=2 and len(sys.argv)!=3 and len(sys.argv)!=4:
+        fatal('Wrong number of arguments for push command')
+    startswith=snapshotPrefix(sys.argv[2:])
+    localRefs=dict((ref,sha) for (sha,ref) in getRefs('refs/gib/') if ref.startswith(startswith))
+    remoteRefs=getRemoteRefs(startswith)
+    wanted=[ref for (ref,sha) in localRefs.items() if remoteRefs.get(ref)!=sha]
+    print 'Pushing %d snapshots to origin (%d already there)'%(len(wanted),len(localRefs)-len(wanted))
+    if wanted:
+        transfer('push',wanted)
+
+def getRefs(prefix,count=None,newestFirst=False):
+    """ generator func for the (sha,refname) pairs of the refs under prefix, sorted by name
+    only the refs under prefix are read, by gitstore or if it can't by git """
+    if useStore and gitstore.supported(gitdir):
+        try:
+            refs=gitstore.readRefs(gitdir,prefix)
+        except (gitstore.Unsupported,EnvironmentError):
+            refs=None
+        if refs is not None:
+            for ref in sorted(refs,reverse=newestFirst)[:count]:
+                yield (refs[ref],ref)
+            return
+    args=['for-each-ref','--format=%(objectname) %(refname)']
+    if newestFirst:
+        args.append('--sort=-refname')
+    if count:
+        args.append('--count=%d'%count)
+    for x in git(*args+['--',prefix],_iter=True):
+        yield tuple(x.rstrip('\n').split(' ',1))
 
+def readRef(ref):
+    """ returns the sha of a full ref name or a sha, either of them optionally followed by ^{tree}, without
+    running git. raises gitstore.Unsupported for anything else """
+    name=ref[:-len('^{tree}')] if ref.endswith('^{tree}') else ref
+    if gitstore.isSha(name):
+        sha=name
+    elif name.startswith('refs/'):
+        sha=gitstore.readRefs(gitdir,name).get(name)
+    else:
+        raise gitstore.Unsupported('%s needs git to resolve it'%ref)
+    if sha and name!=ref:
+        obj=helper(CatFile).read(sha)
+        if not obj:
+            return None
+        if obj[0]=='commit':
+            sha=obj[1].split('\n',1)[0].split()[1]
+        elif obj[0]!='tree':
+            raise gitstore.Unsupported('%s is a %s'%(sha,obj[0]))
+    return sha
 
-def getAllRefs():
-    """ returns a dict with all refs in it, keyed by reference name """
-    allRefs={}
+def getRef(ref):
+    """ returns the sha a ref points to, or None if there is no such ref """
+    if useStore and gitstore.supported(gitdir):
+        try:
+            return readRef(ref)
+        except (gitstore.Unsupported,EnvironmentError):
+            pass
     try:
-        for x in str(git('show-ref')).splitlines():
-            (sha,ref)=x.split(' ',1) 
-            allRefs[ref]=sha
+        return str(git('rev-parse','-q','--verify',ref)).strip()
     except pbs.ErrorReturnCode_1:
-        pass
-    return allRefs
+        return None
+
+def parseTree(data):
+    """ returns the (name,mode,sha) entries of a raw tree object """
+    entries=[]
+    pos=0
+    while pos<len(data):
+        space=data.index(' ',pos)
+        nul=data.index('\0',space)
+        entries.append((data[space+1:nul],data[pos:space],binascii.hexlify(data[nul+1:nul+21])))
+        pos=nul+21
+    return entries
+
+def readTree(catfile,sha):
+    """ returns the (name,mode,sha) entries of a tree in the repro """
+    obj=catfile.read(sha)
+    if not obj or obj[0]!='tree':
+        fatal('Tree %s is missing from the repro'%sha)
+    return parseTree(obj[1])
+
+def treeEntries(catfile,tree):
+    """ returns (name,mode,sha,subtree) for each entry in tree, which is either the sha of a tree in the
+    repro or the entries from scanDirForTree. subtree is what to pass back in to get the entries of a dir """
+    if isinstance(tree,list):
+        return [tuple(entry) for entry in tree]
+    return [(name,mode,sha,sha) for (name,mode,sha) in readTree(catfile,tree)]
+
+def dirEntries(catfile,entry):
+    """ returns the entries (as for treeEntries) of the dir for a tree entry, or None if it isn't a dir.
+    chunked files aren't dirs """
+    if not entry or entry[1]!='40000' or entry[3] is None:
+        return None
+    entries=treeEntries(catfile,entry[3])
+    if chunkedFile(catfile,[sub[:3] for sub in entries]):
+        return None
+    return entries
+
+def displayPath(prefix,name):
+    # the .gibkeep files stand in for empty dirs
+    return prefix if name=='.gibkeep' else prefix+name
+
+def compareTrees(catfile,old,new,prefix=''):
+    """ generator func yielding (change,path,old entry,new entry) for every file that differs between two
+    trees, change is A, M or D. either tree can be None, as are the entries of an added or deleted file. dirs
+    with the same sha on both sides aren't looked inside """
+    oldEntries=dict((entry[0],entry) for entry in treeEntries(catfile,old)) if old else {}
+    newEntries=dict((entry[0],entry) for entry in treeEntries(catfile,new)) if new else {}
+    for name in sorted(set(oldEntries)|set(newEntries)):
+        o=oldEntries.get(name)
+        n=newEntries.get(name)
+        if o and n and o[1]==n[1] and o[2]==n[2]:
+            continue
+        oDir=dirEntries(catfile,o)
+        nDir=dirEntries(catfile,n)
+        if oDir is None and nDir is None:
+            yield ('M' if o and n else 'D' if o else 'A',displayPath(prefix,name),o,n)
+            continue
+        if o and oDir is None:
+            yield ('D',displayPath(prefix,name),o,None)
+        if n and nDir is None:
+            yield ('A',displayPath(prefix,name),None,n)
+        for change in compareTrees(catfile,oDir,nDir,prefix+name+'/'):
+            yield change
+
+def chunkedFile(catfile,entries):
+    """ returns (mode,[chunk shas]) if the (name,mode,sha) entries of a tree are a file stored in chunks
+    by chunkFile, otherwise None. the marker has to be exactly as chunkFile writes it, with the size of the
+    chunks adding up, so a dir that happens to have a .gibchunks file in it is still a dir """
+    if not entries or entries[0][0]!='.gibchunks' or entries[0][1] not in ('100644','100755'):
+        return None
+    chunks=[sha for (name,mode,sha) in entries[1:]]
+    if [(name,mode) for (name,mode,sha) in entries[1:]]!=[('%08d'%i,'100644') for i in range(len(chunks))]:
+        return None
+    marker=catfile.read(entries[0][2])
+    # the marker might not be in the repro if the tree is from 'gib status'
+    if marker:
+        match=re.match(r'^gibchunks 1\nsize (\d+)\n\Z',marker[1]) if marker[0]=='blob' else None
+        if not match or int(match.group(1))!=sum(catfile.size(sha) or 0 for sha in chunks):
+            return None
+    return (entries[0][1],chunks)
 
-def extract():
-    if len(sys.argv)!=5:
+def getSnapshotTree(backupname,snapshotname):
+    """ returns the sha of the tree for a snapshot, or None if there is no such snapshot """
+    return getRef('refs/gib/%s/snapshots/%s^{tree}'%(backupname,snapshotname))
+
+def writeFromRepro(catfile,path,mode,sha):
+    """ writes a blob out of the repro to path as a file of the given git mode
+    sha can also be a list of the blobs of a chunked file, which are joined back together """
+    if mode=='120000':
+        os.symlink(catfile.read(sha)[1],path)
+        return
+    # the umask gets a say in the permissions, as with git checkout
+    fd=os.open(path,os.O_WRONLY|os.O_CREAT|os.O_EXCL,0777 if mode=='100755' else 0666)
+    f=os.fdopen(fd,'wb')
+    try:
+        for blob in sha if isinstance(sha,list) else [sha]:
+            catfile.copy(blob,f)
+    finally:
+        f.close()
+
+def checkEntryName(tree,name):
+    """ fails if a tree entry's name could make extract write outside the destination dir or into a .git dir
+    git never makes trees with names like these, so the snapshot is damaged (or was made to do harm) """
+    if name in ('','.','..') or name.lower()=='.git' or '/' in name or '\0' in name:
+        fatal('The snapshot is damaged, tree %s has an entry named %r'%(tree,name))
+
+def collectTree(catfile,tree,destdir,files):
+    """ makes the dirs of a tree under destdir (which must exist) and adds the (path,mode,sha) of each
+    file in it to files """
+    stack=[(tree,readTree(catfile,tree),destdir)]
+    while stack:
+        (sha,entries,dir)=stack.pop()
+        for (name,mode,entrySha) in entries:
+            checkEntryName(sha,name)
+            path=os.path.join(dir,name)
+            if mode=='40000':
+                subEntries=readTree(catfile,entrySha)
+                chunked=chunkedFile(catfile,subEntries)
+                if chunked:
+                    files.append((path,)+chunked)
+                    continue
+                os.mkdir(path)
+                stack.append((entrySha,subEntries,path))
+            elif name=='.gibkeep' and entrySha==emptyBlob:
+                # only there to keep the (now made) empty dir
+                continue
+            elif mode in ('100644','100755','120000'):
+                files.append((path,mode,entrySha))
+
+def writeFiles(files,jobs=1):
+    """ writes out the (path,mode,sha) files from collectTree using jobs threads with a git process each """
+    inParallel(lambda file : writeFromRepro(helper(CatFile),*file),files,jobs,chunksize=64)
+
+def extractTree(tree,destdir,jobs=1):
+    """ writes out the contents of a tree into destdir (which must exist) without going through an index """
+    files=[]
+    collectTree(helper(CatFile),tree,destdir,files)
+    writeFiles(files,jobs)
+
+def findInTree(catfile,tree,pattern):
+    """ generator func for the (path,mode,sha) entries in a tree matching pattern, which is a path
+    in the tree whose parts can use shell wildcards. only the trees on the way to matches are read """
+    parts=[part for part in pattern.split('/') if part]
+    if not parts:
+        return
+    stack=[(tree,'',parts)]
+    while stack:
+        (sha,prefix,parts)=stack.pop()
+        isGlob=any(c in parts[0] for c in '*?[')
+        for (name,mode,entrySha) in readTree(catfile,sha):
+            if name!=parts[0] and not (isGlob and fnmatch.fnmatchcase(name,parts[0])):
+                continue
+            checkEntryName(sha,name)
+            if len(parts)==1:
+                yield (prefix+name,mode,entrySha)
+            elif mode=='40000':
+                stack.append((entrySha,prefix+name+'/',parts[1:]))
+
+def extractPaths(tree,destdir,pattern,jobs=1):
+    """ writes out just the parts of a tree that match pattern (see findInTree) into destdir, each
+    at the same path it has in the tree. returns how many matched """
+    catfile=helper(CatFile)
+    files=[]
+    matched=0
+    for (path,mode,sha) in findInTree(catfile,tree,pattern):
+        matched+=1
+        dest=os.path.join(destdir,path)
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        if mode=='40000':
+            chunked=chunkedFile(catfile,readTree(catfile,sha))
+            if chunked:
+                files.append((dest,)+chunked)
+                continue
+            os.mkdir(dest)
+            collectTree(catfile,sha,dest,files)
+        elif mode in ('100644','100755','120000') and not (os.path.basename(path)=='.gibkeep' and sha==emptyBlob):
+            files.append((dest,mode,sha))
+    writeFiles(files,jobs)
+    return matched
+
+def snapshotMissing(backupname,snapshotname):
+    fatal('Snapshot %s for backup %s does not exist\nTested %s'%(snapshotname,backupname,'refs/gib/%s/snapshots/%s'%(backupname,snapshotname)))
+
+def extract(args):
+    (opts,args)=getOptions(args,['jobs=','path='])
+    if len(args)!=3:
         fatal('Wrong number of arguments for extract command')
-    (backupname,snapshotname,destdir)=sys.argv[2:5]
-    ref='refs/gib/%s/snapshots/%s'%(backupname,snapshotname)
-    allRefs=getAllRefs()
-    if ref in allRefs:
-        tree=allRefs[ref]
+    (backupname,snapshotname,destdir)=args
+    jobs=getJobs(opts)
+    tree=getSnapshotTree(backupname,snapshotname)
+    if tree:
         if os.path.exists(destdir):
             fatal("Destination %s' already exists - cannot extract!"%(destdir))
-        clearIndex()
-        git('read-tree',tree)
         if not destdir.endswith(os.sep):
             destdir+=os.sep
-        if not os.path.isdir(destdir):
-            os.makedirs(destdir)
-        git('--work-tree=%s'%destdir,'checkout-index','-a')
-        # get rid of the .gibkeep files that were only added to track empty dirs
-        for file in str(git('ls-files','--cached')).splitlines():
-            if file.endswith('.gibkeep'):
-                pbs.rm(os.path.join(destdir,file))
-        clearIndex()
-        print "Extracted backup of '%s' snapshot '%s' to '%s'"%(backupname,snapshotname,destdir)
+        os.makedirs(destdir)
+        if '--path' in opts:
+            if not extractPaths(tree,destdir,opts['--path'],jobs):
+                os.rmdir(destdir)
+                fatal("Nothing in snapshot '%s' of '%s' matches '%s'"%(snapshotname,backupname,opts['--path']))
+            print "Extracted '%s' from backup of '%s' snapshot '%s' to '%s'"%(opts['--path'],backupname,snapshotname,destdir)
+        else:
+            extractTree(tree,destdir,jobs)
+            print "Extracted backup of '%s' snapshot '%s' to '%s'"%(backupname,snapshotname,destdir)
     else:
-        fatal('Snapshot %s for backup %s does not exist\nTested %s'%(snapshotname,backupname,ref))
+        snapshotMissing(backupname,snapshotname)
+
+def cat(args):
+    if len(args)!=3:
+        fatal('Wrong number of arguments for cat command')
+    (backupname,snapshotname,path)=args
+    tree=getSnapshotTree(backupname,snapshotname)
+    if not tree:
+        snapshotMissing(backupname,snapshotname)
+    # a literal path, even if it has wildcard characters in it
+    catfile=helper(CatFile)
+    found=None
+    for part in [part for part in path.split('/') if part]:
+        if found and found[1]!='40000':
+            found=None
+            break
+        found=([entry for entry in readTree(catfile,found[2] if found else tree) if entry[0]==part] or [None])[0]
+        if not found:
+            break
+    blobs=[found[2]] if found else []
+    if found and found[1]=='40000':
+        chunked=chunkedFile(catfile,readTree(catfile,found[2]))
+        blobs=chunked[1] if chunked else []
+    if not blobs:
+        fatal("'%s' is not a file in snapshot '%s' of '%s'"%(path,snapshotname,backupname))
+    for blob in blobs:
+        catfile.copy(blob,sys.stdout)
+    sys.stdout.flush()
+
+class LRUCache(object):
+    """ a cache shared between threads, holding values up to a total size, the least recently used being dropped
+    to make room """
+    def __init__(self,size):
+        self.size=size
+        self.used=0
+        self.values=OrderedDict()
+        self.lock=threading.Lock()
+
+    def get(self,key):
+        """ returns a cached value, or None if it isn't cached """
+        with self.lock:
+            value=self.values.pop(key,None)
+            if value is None:
+                return None
+            self.values[key]=value
+            return value[0]
+
+    def put(self,key,value,size):
+        # something big would push out too much else
+        if size>self.size//8:
+            return
+        with self.lock:
+            if key in self.values:
+                return
+            self.values[key]=(value,size)
+            self.used+=size
+            while self.used>self.size:
+                (oldKey,(oldValue,oldSize))=self.values.popitem(last=False)
+                self.used-=oldSize
+
+def parseRange(header,total):
+    """ returns the (first,last) bytes asked for by an HTTP Range header with a single range, None if the whole
+    file should be sent (no header, or one that isn't understood) or False if the range is outside the file """
+    match=re.match(r'^bytes=(\d*)-(\d*)$',header.strip()) if header else None
+    if not match or match.groups()==('',''):
+        return None
+    (first,last)=match.groups()
+    if not first:
+        # the last bytes
+        if not int(last) or not total:
+            return False
+        return (max(total-int(last),0),total-1)
+    if last and int(last)<int(first):
+        return None
+    if int(first)>=total:
+        return False
+    return (int(first),min(int(last),total-1) if last else total-1)
+
+class PooledHTTPServer(BaseHTTPServer.HTTPServer):
+    """ an HTTP server that handles requests on a fixed pool of threads, each with its own helpers """
+    # how long the list of snapshots is used for before the refs are read again
+    snapshotsTTL=2
+
+    def __init__(self,address,handler,threads,cacheSize):
+        BaseHTTPServer.HTTPServer.__init__(self,address,handler)
+        self.cache=LRUCache(cacheSize)
+        self.snapshotsLock=threading.Lock()
+        self.snapshotsRead=None
+        self.queue=Queue.Queue(threads*4)
+        for i in range(threads):
+            thread=threading.Thread(target=self.worker)
+            thread.daemon=True
+            thread.start()
+
+    def process_request(self,request,client):
+        self.queue.put((request,client))
+
+    def snapshots(self):
+        """ returns the names of the snapshots of each backup, keyed by backup name. the refs are read again
+        once the list is snapshotsTTL seconds old, not for every request """
+        with self.snapshotsLock:
+            if self.snapshotsRead is None or time.time()-self.snapshotsRead>=self.snapshotsTTL:
+                snapshots={}
+                for (sha,ref) in getRefs('refs/gib/'):
+                    if '/snapshots/' in ref:
+                        (backupname,snapshotname)=ref[len('refs/gib/'):].rsplit('/snapshots/',1)
+                        snapshots.setdefault(backupname,[]).append(snapshotname)
+                (self.snapshotList,self.snapshotsRead)=(snapshots,time.time())
+            return self.snapshotList
+
+    def worker(self):
+        while True:
+            (request,client)=self.queue.get()
+            try:
+                self.finish_request(request,client)
+            except Exception:
+                self.handle_error(request,client)
+            finally:
+                self.shutdown_request(request)
+
+class SnapshotHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ serves the snapshots in the repro read-only. / lists the backups, /backupname/ its snapshots and
+    /backupname/snapshotname/path a dir in the snapshot or downloads a file """
+    server_version='gib/0.1'
+
+    def do_GET(self):
+        self.get(True)
+
+    def do_HEAD(self):
+        self.get(False)
+
+    def get(self,body):
+        try:
+            self.serve(body)
+        except socket.error:
+            # the client went away
+            pass
+        except (Exception,SystemExit),e:
+            # the next request gets a new cat-file, in case this one died
+            dropHelper(CatFile)
+            self.log_error('%s failed: %s',self.path,e)
+            try:
+                self.send_error(500)
+            except socket.error:
+                pass
+
+    def serve(self,body):
+        path=self.path.split('?',1)[0]
+        parts=[urllib.unquote(part) for part in path.split('/')[1:]]
+        isDir=not parts[-1]
+        if isDir:
+            parts.pop()
+        # nothing can be named like these in a snapshot, and they mustn't get into a ref name
+        if any(part in ('','.','..') or '/' in part or '\0' in part for part in parts):
+            self.send_error(404)
+            return
+        snapshots=self.server.snapshots()
+        if not parts:
+            self.sendListing('Backups',[(name+'/','') for name in sorted(snapshots)],body)
+            return
+        if parts[0] not in snapshots:
+            self.send_error(404)
+            return
+        if len(parts)==1:
+            if not isDir:
+                self.redirect(path+'/')
+                return
+            self.sendListing('Snapshots of %s'%parts[0],[(name+'/','') for name in snapshots[parts[0]]],body)
+            return
+        tree=getSnapshotTree(parts[0],parts[1]) if parts[1] in snapshots[parts[0]] else None
+        if not tree:
+            self.send_error(404)
+            return
+        entry=('','40000',tree)
+        for part in parts[2:]:
+            found=[sub for sub in self.tree(entry[2]) if sub[0]==part] if entry[1]=='40000' else []
+            if not found or self.chunks(entry[2]):
+                self.send_error(404)
+                return
+            entry=found[0]
+        if entry[1]=='40000' and not self.chunks(entry[2]):
+            if not isDir:
+                self.redirect(path+'/')
+                return
+            catfile=helper(CatFile)
+            entries=[]
+            for (name,mode,sha) in self.tree(entry[2]):
+                if name=='.gibkeep' and sha==emptyBlob:
+                    continue
+                chunks=self.chunks(sha) if mode=='40000' else [(sha,catfile.size(sha) or 0)]
+                if chunks:
+                    entries.append((name,str(sum(size for (chunk,size) in chunks))))
+                else:
+                    entries.append((name+'/',''))
+            self.sendListing('/'.join(parts),entries,body)
+        elif isDir:
+            self.send_error(404)
+        else:
+            self.sendFile(entry,body)
+
+    def tree(self,sha):
+        """ returns the (name,mode,sha) entries of a tree """
+        key=('tree',sha)
+        entries=self.server.cache.get(key)
+        if entries is None:
+            entries=readTree(helper(CatFile),sha)
+            self.server.cache.put(key,entries,sum(len(name)+64 for (name,mode,entrySha) in entries))
+        return entries
+
+    def chunks(self,sha):
+        """ returns the (sha,size) chunks of the file a tree stands for, or None if it isn't a chunked file """
+        key=('chunks',sha)
+        chunks=self.server.cache.get(key)
+        if chunks is None:
+            catfile=helper(CatFile)
+            chunked=chunkedFile(catfile,self.tree(sha))
+            chunks=[(chunk,catfile.size(chunk) or 0) for chunk in chunked[1]] if chunked else []
+            self.server.cache.put(key,chunks,64*len(chunks)+64)
+        return chunks or None
+
+    def redirect(self,location):
+        self.send_response(301)
+        self.send_header('Location',location)
+        self.send_header('Content-Length','0')
+        self.end_headers()
+
+    def sendListing(self,title,entries,body):
+        """ sends an HTML page linking to the (name,size) entries, dirs having names ending in / """
+        lines=['<html><head><title>%s</title></head><body><h1>%s</h1><table>'%(cgi.escape(title),cgi.escape(title)),
+            '<tr><td><a href="../">../</a></td><td></td></tr>']
+        for (name,size) in entries:
+            lines.append('<tr><td><a href="%s">%s</a></td><td align="right">%s</td></tr>'%(
+                urllib.quote(name.rstrip('/'),safe='')+('/' if name.endswith('/') else ''),cgi.escape(name),size))
+        lines.append('</table></body></html>\n')
+        page='\n'.join(lines)
+        self.send_response(200)
+        self.send_header('Content-Type','text/html; charset=utf-8')
+        self.send_header('Content-Length',str(len(page)))
+        self.end_headers()
+        if body:
+            self.wfile.write(page)
+
+    def sendFile(self,entry,body):
+        """ sends a file, or the part of it asked for with a Range header """
+        (name,mode,sha)=entry
+        catfile=helper(CatFile)
+        parts=self.chunks(sha) if mode=='40000' else [(sha,catfile.size(sha) or 0)]
+        total=sum(size for (part,size) in parts)
+        # snapshots never change, so neither does what is at a path in one
+        etag='"%s"'%sha
+        if self.headers.get('If-None-Match')==etag:
+            self.send_response(304)
+            self.send_header('ETag',etag)
+            self.end_headers()
+            return
+        wanted=parseRange(self.headers.get('Range'),total)
+        if wanted is False:
+            self.send_response(416)
+            self.send_header('Content-Range','bytes */%d'%total)
+            self.send_header('Content-Length','0')
+            self.end_headers()
+            return
+        (first,last)=wanted or (0,total-1)
+        self.send_response(206 if wanted else 200)
+        if mode=='120000':
+            self.send_header('Content-Type','text/plain')
+        else:
+            self.send_header('Content-Type',mimetypes.guess_type(name)[0] or 'application/octet-stream')
+        self.send_header('Content-Length',str(last-first+1))
+        self.send_header('Accept-Ranges','bytes')
+        self.send_header('ETag',etag)
+        if wanted:
+            self.send_header('Content-Range','bytes %d-%d/%d'%(first,last,total))
+        self.end_headers()
+        if not body:
+            return
+        start=0
+        for (part,size) in parts:
+            if start+size>first and start<=last:
+                self.sendBlob(part,size,max(first-start,0),min(last-start,size-1))
+            start+=size
+
+    def sendBlob(self,sha,size,first,last):
+        """ sends bytes first to last of a blob. small blobs are cached whole, big ones are streamed """
+        key=('blob',sha)
+        data=self.server.cache.get(key)
+        if data is None and size<=self.server.cache.size//8:
+            data=helper(CatFile).read(sha)[1]
+            self.server.cache.put(key,data,len(data))
+        if data is not None:
+            self.wfile.write(data[first:last+1])
+            return
+        (kind,size,blocks)=helper(CatFile).open(sha)
+        try:
+            pos=0
+            for block in blocks:
+                if pos+len(block)>first:
+                    self.wfile.write(block[max(first-pos,0):last+1-pos])
+                pos+=len(block)
+                if pos>last:
+                    break
+        finally:
+            blocks.close()
+
+def serve(args):
+    (opts,args)=getOptions(args,['bind=','port=','threads=','cache-size='])
+    if len(args)!=0:
+        fatal('Wrong number of arguments for serve command')
+    try:
+        port=int(opts.get('--port',8080))
+        threads=int(opts.get('--threads',8))
+    except ValueError:
+        fatal('--port and --threads must be numbers')
+    if threads<1:
+        fatal('--threads must be 1 or more')
+    try:
+        server=PooledHTTPServer((opts.get('--bind','127.0.0.1'),port),SnapshotHandler,threads,
+            getSize(opts,'--cache-size',64*1024*1024))
+    except socket.error,e:
+        fatal("Can't listen on port %d: %s"%(port,e))
+    print 'Serving the snapshots in %s on http://%s:%d/ (ctrl-c to stop)'%(os.path.abspath(gitdir),
+        server.server_address[0],server.server_address[1])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
 
 def usage():
     print 'gib 0.1'
@@ -211,37 +1965,150 @@ def usage():
     print
     print 'Usage:'
     print
-    print 'gib snapshot <backupname> <path to backup>+'
+    print 'gib [--profile] [--trace-json <file>] <command> ...'
+    print '  --profile prints how long the git commands run by the command took, by git'
+    print '  subcommand, to stderr when it finishes'
+    print '  --trace-json <file> writes every git command it ran to <file> as JSON: its'
+    print '  arguments, start time, wall time, exit code, and the bytes gib sent it and'
+    print '  read back from it'
+    print
+    print 'gib snapshot [--jobs N] [--index] [--commit] [--chunk-threshold SIZE]'
+    print '             [--stdin <name>] <backupname> <path to backup>*'
     print '  will take a snapshot of the given path(s) and save it'
     print '  directories will be recursively backed up and placed in a dir at the'
     print '  root level of the snapshot'
     print '  if a path is a file, the file will be backed up to the root level of'
     print '  the snapshot'
     print '  it will write the tree to refs/gib/backupname/snapshots/YYYYMMDD_HHMMSS'
+    print '  only files and dirs that changed since the last snapshot are re-imported'
+    print '  --jobs N hashes changed files with N git processes at once'
+    print '  --index builds the tree through a git index instead (same result, slower,'
+    print '  always one job)'
+    print '  --commit wraps the tree in a commit whose parent is the previous snapshot,'
+    print '  so fetch and push only send what changed. once the last snapshot of a backup'
+    print '  is a commit, new snapshots are always commits. commit snapshots each keep all'
+    print '  the ones before them, so only prune --rewrite-commits can remove them'
+    print '  --chunk-threshold SIZE stores files of SIZE bytes or more (eg. 64M) as a tree'
+    print '  of chunks cut at line ends, so a big file with a few changes, such as a'
+    print '  database dump, only adds the changed chunks. extract and cat join them back up'
+    print '  --stdin <name> also stores whatever is piped in as the file <name> at the root'
+    print '  level of the snapshot, eg. mysqldump db | gib snapshot db --stdin db.sql'
+    print '  the paths can be left out with --stdin. the data isn\'t written anywhere else'
+    print '  first. up to SIZE bytes of it (16M without --chunk-threshold) are held in'
+    print '  memory to see whether it needs chunking, and if it does the rest is chunked as'
+    print '  it comes in, so memory stays bounded however much is piped in. --stdin can\'t'
+    print '  be used with --index'
+    print
+    print 'gib snapshot-all [--jobs N] <config file>'
+    print '  snapshots every backup in the config file, N of them at once (by default as'
+    print '  many as there are CPUs), each in its own process. the config file has a'
+    print '  section for each backup:'
+    print '    [backupname]'
+    print '    paths = /var/www/blog'
+    print '            /tmp/blog.sql'
+    print '  and can also set jobs, commit, index and chunk-threshold as for snapshot'
+    print '  snapshots of different backups never get in each other\'s way, even from'
+    print '  separate gib commands, but a backup can only be snapshotted by one at a time'
+    print
+    print 'gib status [--jobs N] [--chunk-threshold SIZE] <backupname> <path to backup>+'
+    print '  shows what a snapshot of the path(s) would change since the last snapshot,'
+    print '  A for added, M for modified and D for deleted files'
+    print '  only files whose stat data changed since the last snapshot are hashed (all of'
+    print '  them if the last snapshot wasn\'t made here). nothing is written to the repro'
+    print
+    print 'gib verify [--jobs N] [--sample N%] <backupname> [snapshotname]'
+    print '  checks the snapshot (or every snapshot of the backup) is intact in the repro,'
+    print '  by reading back every object it uses and working out its sha again. only'
+    print '  those objects are looked at, not the whole repro as with "git fsck"'
+    print '  --jobs N checks N objects at once'
+    print '  --sample N% only checks N% of the files, picked at random, all the dirs are'
+    print '  still checked'
+    print
+    print 'gib verify --live [--jobs N] [--chunk-threshold SIZE] <backupname> <snapshotname>'
+    print '           <path>+'
+    print '  compares a snapshot with the files at the path(s) as they are now, reading'
+    print '  all of them. prints A for files only at the paths, D for files only in the'
+    print '  snapshot and M for files that differ. give the same paths and chunk threshold'
+    print '  the snapshot was made with'
+    print
+    print 'gib diff [--stat] [--renames] <backupname> <snapshotname> <snapshotname>'
+    print '  lists the files that differ between two snapshots, as they are found, with'
+    print '  A for added, M for modified and D for deleted, and their sizes in bytes (old'
+    print '  and new for modified files). dirs that are the same in both are skipped'
+    print '  without being looked in, nothing is extracted'
+    print '  --renames shows a file deleted in one place and added with the same contents'
+    print '  in another as R old -> new. the added and deleted files are then listed at'
+    print '  the end'
+    print '  --stat only prints how many files were added, modified and deleted, and how'
+    print '  many bytes that came to'
     print
     print 'gib list [backupname]'
     print '  will list all available snapshots for [backupname]'
     print '  if backupname is ommitted, it will list all available snapshots for all'
     print '  backups'
     print
-    print 'gib extract <backupname> <snapshotname> <destdir>'
+    print 'gib extract [--jobs N] [--path <path>] <backupname> <snapshotname> <destdir>'
     print '  extract a backup to the directory <destdir>'
     print '  <destdir> must not already exist'
+    print '  --jobs N writes N files at once'
+    print '  --path only extracts the files and dirs in the snapshot matching <path>,'
+    print '  which can use shell wildcards, eg. --path \'blog/uploads/2012/*\''
+    print
+    print 'gib cat <backupname> <snapshotname> <path>'
+    print '  writes the file at <path> in a snapshot to stdout'
+    print
+    print 'gib serve [--bind ADDRESS] [--port N] [--threads N] [--cache-size SIZE]'
+    print '  serves the snapshots read-only over HTTP, on 127.0.0.1:8080 by default (use'
+    print '  --bind 0.0.0.0 to let other machines in). / lists the backups, /backupname/'
+    print '  its snapshots and /backupname/snapshotname/path/ the dirs in a snapshot, and'
+    print '  files can be downloaded from them, with ranges, so downloads can be resumed'
+    print '  requests are handled by N threads at once (default 8). trees and small files'
+    print '  are cached in memory, up to SIZE in all (default 64M)'
     print
     print 'gib delete <backupname> <snapshotname>'
     print '  removes a backup from the system'
     print '  space won\'t be reclaimed until a "git gc" is done'
+    print '  a snapshot made with --commit stays reachable through the parent links of'
+    print '  the snapshots after it, so deleting it wouldn\'t free anything and is refused,'
+    print '  see prune --rewrite-commits'
+    print
+    print 'gib prune [--dry-run] [--rewrite-commits] [--keep-daily N] [--keep-weekly N]'
+    print '          [--keep-monthly N] <backupname>'
+    print '  deletes the snapshots of a backup that a retention policy doesn\'t keep. it'
+    print '  keeps the newest snapshot of each of the last N days, weeks and months that'
+    print '  have snapshots, and always keeps the newest snapshot. all the snapshots go in'
+    print '  one go, --dry-run only lists them. as with delete, space is reclaimed by'
+    print '  "git gc". snapshots made with --commit are skipped, as the ones after them'
+    print '  keep them reachable'
+    print '  --rewrite-commits deletes those too, making the kept commit snapshots again'
+    print '  (same trees and dates) so that each one\'s parent is the kept one before it.'
+    print '  the ones made again get new shas, so if they were pushed before, the old ones'
+    print '  have to be deleted from origin before they can be pushed again'
+    print
+    print 'gib maintain [--time-budget SECONDS] [--no-prune] [--prune-expire DATE]'
+    print '  keeps the repro quick to use without ever repacking all of it. packs loose'
+    print '  objects, merging packs geometrically so big old packs are left alone, writes'
+    print '  a multi-pack-index with a bitmap, a commit-graph if there are commit'
+    print '  snapshots, then prunes unreachable loose objects older than DATE (default'
+    print '  2.weeks.ago). with a time budget, no new step is started once it is used up,'
+    print '  so it can be run after every snapshot. unreachable objects that are already'
+    print '  packed are only dropped by a "git gc"'
     print
     print 'gib list-remote [backupname]'
     print '  list all remote backups for backupname'
     print '  if backupname is omitted, lists all remote backups'
     print '  always lists the git remote named "origin"'
     print
-    print 'gib fetch <backupname> <snapshotname>'
-    print '  fetches a remote branch'
+    print 'gib fetch [backupname [snapshotname]]'
+    print '  fetches remote backups, all the snapshots are fetched together'
+    print '  snapshotname can be the start of a name, eg. 201209 for all of September'
+    print '  snapshots that have already been fetched are skipped'
     print '  after fetching, you can extract it'
     print '  always fetches from the git remote named "origin"'
     print
+    print 'gib push [backupname [snapshotname]]'
+    print '  pushes backups to the git remote named "origin" in the same way'
+    print
 
 invokedFromShell=False
 
@@ -252,27 +2119,121 @@ def fatal(x):
     else:
         raise(Exception(x))
 
-if __name__ == "__main__":
-    invokedFromShell=True
-    if not (os.path.isdir(os.path.join(gitdir,'objects')) and os.path.isdir(os.path.join(gitdir,'refs'))):
-        fatal("Should be ran from inside the git repro")
-    if len(sys.argv)==1:
-        usage()
-        sys.exit(1)
-    if sys.argv[1]=='snapshot':
-        snapshot(sys.argv[2:])
-    elif sys.argv[1]=='list':
+# the git commands run by this gib command, as pbs trace records, if --profile or --trace-json asked for them
+traced=[]
+
+# git's own options that take their value as a separate argument
+gitValueOptions=('-C','-c','--git-dir','--work-tree','--namespace','--exec-path','--super-prefix')
+
+def gitSubcommand(argv):
+    """ returns the git subcommand (eg. cat-file) in a traced command line """
+    args=iter(argv[1:])
+    for arg in args:
+        if arg in gitValueOptions:
+            next(args,None)
+        elif not arg.startswith('-'):
+            return arg
+    return 'git'
+
+def printProfile(elapsed):
+    """ prints how long the traced git commands took, by subcommand, to stderr
+    with --jobs the commands overlap, so their times can add up to more than gib took """
+    summary={}
+    for record in traced:
+        name=gitSubcommand(record['argv'])
+        (runs,wall,longest,bytesIn,bytesOut,failed)=summary.get(name,(0,0,0,0,0,0))
+        summary[name]=(runs+1,wall+record['wall'],max(longest,record['wall']),bytesIn+record['bytes_in'],
+            bytesOut+record['bytes_out'],failed+(record['exit_code']!=0))
+    lines=['%-20s %6s %9s %9s %12s %12s %6s'%('git command','runs','total s','max s','bytes in','bytes out','failed')]
+    for (name,(runs,wall,longest,bytesIn,bytesOut,failed)) in sorted(summary.items(),key=lambda item : -item[1][1]):
+        lines.append('%-20s %6d %9.3f %9.3f %12d %12d %6d'%(name,runs,wall,longest,bytesIn,bytesOut,failed))
+    lines.append('%d git commands took %.3fs, gib took %.3fs'%(len(traced),sum(record['wall'] for record in traced),elapsed))
+    sys.stderr.write('\n'.join(lines)+'\n')
+
+def writeTrace(path,args,start,elapsed,ok):
+    """ writes the traced git commands, and how the gib command went, to path as JSON """
+    def text(arg):
+        # paths needn't be utf8
+        return arg.decode('utf8','replace') if isinstance(arg,str) else arg
+    trace={'gib':[text(arg) for arg in args],'start':start,'wall':elapsed,'ok':ok,
+           'commands':[dict(record,argv=[text(arg) for arg in record['argv']],subcommand=gitSubcommand(record['argv']))
+                       for record in sorted(traced,key=lambda record : record['start'])]}
+    try:
+        f=open(path,'w')
+        try:
+            json.dump(trace,f,indent=1,sort_keys=True)
+        finally:
+            f.close()
+    except (IOError,OSError),e:
+        sys.stderr.write("Can't write trace to %s: %s\n"%(path,e))
+
+def main(args):
+    if args[0]=='snapshot':
+        snapshot(args[1:])
+    elif args[0]=='snapshot-all':
+        snapshotAll(args[1:])
+    elif args[0]=='status':
+        status(args[1:])
+    elif args[0]=='serve':
+        serve(args[1:])
+    elif args[0]=='diff':
+        diff(args[1:])
+    elif args[0]=='verify':
+        verify(args[1:])
+    elif args[0]=='prune':
+        prune(args[1:])
+    elif args[0]=='maintain':
+        maintain(args[1:])
+    elif args[0]=='list':
         list_()
-    elif sys.argv[1]=='extract':
-        extract()
-    elif sys.argv[1]=='delete':
+    elif args[0]=='extract':
+        extract(args[1:])
+    elif args[0]=='cat':
+        cat(args[1:])
+    elif args[0]=='delete':
         delete_()
-    elif sys.argv[1]=='list-remote':
+    elif args[0]=='list-remote':
         listremote()
-    elif sys.argv[1]=='fetch':
+    elif args[0]=='fetch':
         fetch()
-    elif sys.argv[1]=='help' or sys.argv[1]=='--help':
+    elif args[0]=='push':
+        push()
+    elif args[0]=='help' or args[0]=='--help':
         usage()
     else:
-        print 'Unknown command %s'%sys.argv[1]
+        print 'Unknown command %s'%args[0]
+        sys.exit(1)
+
+if __name__ == "__main__":
+    invokedFromShell=True
+    if not (os.path.isdir(os.path.join(gitdir,'objects')) and os.path.isdir(os.path.join(gitdir,'refs'))):
+        fatal("Should be ran from inside the git repro")
+    # options for gib itself go before the command, the commands that read sys.argv mustn't see them. anything
+    # else (such as --help) is left for main
+    gibOpts=[]
+    if sys.argv[1:] and sys.argv[1].split('=',1)[0] in ('--profile','--trace-json'):
+        try:
+            (gibOpts,sys.argv[1:])=getopt.getopt(sys.argv[1:],'',['profile','trace-json='])
+        except getopt.GetoptError,e:
+            fatal(str(e))
+    gibOpts=dict(gibOpts)
+    if len(sys.argv)==1:
+        usage()
         sys.exit(1)
+    if gibOpts:
+        pbs.add_trace_hook(traced.append)
+    start=time.time()
+    ok=False
+    try:
+        try:
+            main(sys.argv[1:])
+        except:
+            closeHelpers(True)
+            raise
+        closeHelpers()
+        ok=True
+    finally:
+        if '--profile' in gibOpts:
+            printProfile(time.time()-start)
+        if '--trace-json' in gibOpts:
+            writeTrace(gibOpts['--trace-json'],sys.argv[1:],start,time.time()-start,ok)
@@ -0,0 +1,553 @@
+#===============================================================================
+# gitstore.py
+# Reads objects and refs straight out of a git repro's files, so that commands
+# that only look at the repro don't have to start git processes.
+#
+# Loose objects and packs with version 2 .idx files are read, the packs and
+# their indexes through mmap. Deltas are resolved with a bounded cache of the
+# objects recently resolved, so a chain of deltas sharing bases is only
+# inflated once. Anything it doesn't understand (sha256 repros, reftables,
+# symbolic refs, old index versions, damaged data) raises Unsupported, and
+# the caller should ask git instead. Objects that aren't found might be in an
+# alternate, so git should be asked about those too.
+#===============================================================================
+
+import os,re,zlib,mmap,struct,binascii
+from collections import OrderedDict
+
+class Unsupported(Exception):
+    """ the repro has something in it that can't be read here, git has to be asked instead """
+
+typeNames={1:'commit',2:'tree',3:'blob',4:'tag'}
+ofsDelta=6
+refDelta=7
+
+# how much is inflated at once, and how much of a pack is fed to zlib at once
+blockSize=1024*1024
+readSize=64*1024
+
+isSha=re.compile('^[0-9a-f]{40}$').match
+
+# whether each git dir seen has formats that can be read here
+supportedDirs={}
+
+def supported(gitdir):
+    """ returns whether the objects and refs of the repro at gitdir are in formats this module reads,
+    sha1 objects and refs in files """
+    if gitdir not in supportedDirs:
+        supportedDirs[gitdir]=readSupported(gitdir)
+    return supportedDirs[gitdir]
+
+def readSupported(gitdir):
+    try:
+        f=open(os.path.join(gitdir,'config'))
+    except IOError:
+        return False
+    try:
+        section=None
+        for line in f:
+            line=line.split('#',1)[0].split(';',1)[0].strip()
+            if line.startswith('['):
+                section=line.strip('[]').strip().lower()
+            elif section=='extensions' and '=' in line:
+                (key,value)=[part.strip().lower() for part in line.split('=',1)]
+                if (key=='objectformat' and value!='sha1') or (key=='refstorage' and value!='files'):
+                    return False
+    finally:
+        f.close()
+    return True
+
+def byte(data,pos):
+    return ord(data[pos:pos+1])
+
+def inflate(source,size=None):
+    """ generator func for the data of the zlib stream in the blocks from the iterator source, a block of
+    at most blockSize at a time. stops after size bytes if size is given, otherwise at the end of source """
+    d=zlib.decompressobj()
+    pending=b''
+    left=size
+    try:
+        while left is None or left>0:
+            if not pending:
+                pending=next(source,b'')
+                if not pending:
+                    if left:
+                        raise Unsupported('object data is cut short')
+                    break
+            block=d.decompress(pending,blockSize if left is None else min(left,blockSize))
+            pending=d.unconsumed_tail
+            if block:
+                if left is not None:
+                    left-=len(block)
+                yield block
+        if left is None:
+            block=d.flush()
+            if block:
+                yield block
+    except zlib.error as e:
+        raise Unsupported('object data is damaged: %s'%e)
+
+def sliceBlocks(data,pos):
+    """ generator func for data (a string or mmap) from pos on, readSize at a time """
+    while pos<len(data):
+        yield data[pos:pos+readSize]
+        pos+=readSize
+
+def deltaSize(delta,pos):
+    """ returns (size,pos after it) for a size at the start of a delta """
+    size=0
+    shift=0
+    while True:
+        c=delta[pos]
+        pos+=1
+        size|=(c&0x7f)<<shift
+        shift+=7
+        if not c&0x80:
+            return (size,pos)
+
+def applyDelta(base,delta):
+    """ returns the object made by applying delta (a bytearray) to base """
+    try:
+        (baseSize,pos)=deltaSize(delta,0)
+        (size,pos)=deltaSize(delta,pos)
+        if baseSize!=len(base):
+            raise Unsupported('delta is for a base of %d bytes, not %d'%(baseSize,len(base)))
+        result=bytearray()
+        end=len(delta)
+        while pos<end:
+            c=delta[pos]
+            pos+=1
+            if c&0x80:
+                # copy from the base, the flags say which bytes of offset and length follow
+                offset=0
+                length=0
+                for i in range(4):
+                    if c&(1<<i):
+                        offset|=delta[pos]<<(8*i)
+                        pos+=1
+                for i in range(3):
+                    if c&(0x10<<i):
+                        length|=delta[pos]<<(8*i)
+                        pos+=1
+                result+=base[offset:offset+(length or 0x10000)]
+            elif c:
+                result+=delta[pos:pos+c]
+                pos+=c
+            else:
+                raise Unsupported('delta has a zero opcode')
+    except IndexError:
+        raise Unsupported('delta is cut short')
+    if len(result)!=size:
+        raise Unsupported('delta made %d bytes, not %d'%(len(result),size))
+    return bytes(result)
+
+def mapFile(path):
+    f=open(path,'rb')
+    try:
+        return mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+class Pack(object):
+    """ a pack and its version 2 .idx, both mapped into memory """
+    def __init__(self,idxPath):
+        self.idx=mapFile(idxPath)
+        if self.idx[:8]!=b'\377tOc\0\0\0\2':
+            self.idx.close()
+            raise Unsupported('%s is not a version 2 pack index'%idxPath)
+        self.fanout=struct.unpack('>256I',self.idx[8:1032])
+        count=self.fanout[255]
+        # sorted shas, then a crc each, a 4 byte offset each and 8 byte offsets for those that need them
+        self.shas=1032
+        self.offsets=self.shas+count*24
+        self.bigOffsets=self.offsets+count*4
+        self.pack=mapFile(idxPath[:-4]+'.pack')
+        if self.pack[:4]!=b'PACK' or struct.unpack('>I',self.pack[4:8])[0] not in (2,3):
+            self.close()
+            raise Unsupported('%s is not a version 2 or 3 pack'%idxPath[:-4])
+
+    def close(self):
+        self.idx.close()
+        if hasattr(self,'pack'):
+            self.pack.close()
+
+    def find(self,binsha):
+        """ returns the offset of an object in the pack, or None if it isn't in it """
+        first=byte(binsha,0)
+        lo=self.fanout[first-1] if first else 0
+        hi=self.fanout[first]
+        while lo<hi:
+            mid=(lo+hi)//2
+            pos=self.shas+mid*20
+            here=self.idx[pos:pos+20]
+            if here<binsha:
+                lo=mid+1
+            elif here>binsha:
+                hi=mid
+            else:
+                offset=struct.unpack('>I',self.idx[self.offsets+mid*4:self.offsets+mid*4+4])[0]
+                if offset&0x80000000:
+                    pos=self.bigOffsets+(offset&0x7fffffff)*8
+                    offset=struct.unpack('>Q',self.idx[pos:pos+8])[0]
+                return offset
+        return None
+
+    def header(self,offset):
+        """ returns (type number,size,offset of the zlib data,base) for the object at offset. base is the
+        offset of the base of an ofs-delta, or the binary sha of the base of a ref-delta """
+        pos=offset
+        c=byte(self.pack,pos)
+        pos+=1
+        kind=(c>>4)&7
+        size=c&15
+        shift=4
+        while c&0x80:
+            c=byte(self.pack,pos)
+            pos+=1
+            size|=(c&0x7f)<<shift
+            shift+=7
+        base=None
+        if kind==ofsDelta:
+            c=byte(self.pack,pos)
+            pos+=1
+            distance=c&0x7f
+            while c&0x80:
+                c=byte(self.pack,pos)
+                pos+=1
+                distance=((distance+1)<<7)|(c&0x7f)
+            base=offset-distance
+        elif kind==refDelta:
+            base=self.pack[pos:pos+20]
+            pos+=20
+        elif kind not in typeNames:
+            raise Unsupported('object at %d has unknown type %d'%(offset,kind))
+        return (kind,size,pos,base)
+
+    def inflate(self,pos,size):
+        return inflate(sliceBlocks(self.pack,pos),size)
+
+    def deltaResultSize(self,pos):
+        """ returns the size of the object a delta whose zlib data is at pos makes, only inflating the start of
+        the delta, where the sizes of its base and result are """
+        d=zlib.decompressobj()
+        start=b''
+        try:
+            # the two sizes take at most 20 bytes
+            while len(start)<32:
+                start+=d.decompress(self.pack[pos:pos+64],32-len(start))
+                pos+=64
+                try:
+                    return deltaSize(bytearray(start),deltaSize(bytearray(start),0)[1])[0]
+                except IndexError:
+                    if d.unconsumed_tail or pos>=len(self.pack):
+                        break
+        except zlib.error as e:
+            raise Unsupported('object data is damaged: %s'%e)
+        raise Unsupported('delta at %d is cut short'%pos)
+
+class ObjectStore(object):
+    """ reads the objects in a repro's objects dir. it isn't thread safe, each thread needs its own """
+    def __init__(self,gitdir,cacheSize=96*1024*1024):
+        self.objects=os.path.join(gitdir,'objects')
+        # Pack, or None for one that can't be read here, keyed by .idx path
+        self.packs={}
+        # (type,data) keyed by (pack,offset), least recently used first. 96MB by default, as git's own
+        # delta base cache
+        self.cache=OrderedDict()
+        self.cacheSize=cacheSize
+        self.cached=0
+        self.scanPacks()
+
+    def close(self):
+        for pack in self.packs.values():
+            if pack:
+                pack.close()
+        self.packs={}
+        self.cache.clear()
+        self.cached=0
+
+    def scanPacks(self):
+        """ opens packs that have appeared since the last scan and forgets those that have gone, returns
+        whether there were any new ones """
+        dir=os.path.join(self.objects,'pack')
+        try:
+            names=set(os.listdir(dir))
+        except OSError:
+            names=set()
+        paths=set(os.path.join(dir,name) for name in names if name.endswith('.idx') and name[:-4]+'.pack' in names)
+        for path in set(self.packs)-paths:
+            pack=self.packs.pop(path)
+            if pack:
+                pack.close()
+        for key in [key for key in self.cache if key[0] not in self.packs.values()]:
+            self.cached-=len(self.cache.pop(key)[1])
+        new=paths-set(self.packs)
+        for path in new:
+            try:
+                self.packs[path]=Pack(path)
+            except (Unsupported,EnvironmentError,ValueError):
+                # git can still read it
+                self.packs[path]=None
+        return bool(new)
+
+    def find(self,binsha):
+        """ returns (pack,offset) for an object in one of the packs, or None """
+        for pack in self.packs.values():
+            if pack:
+                offset=pack.find(binsha)
+                if offset is not None:
+                    return (pack,offset)
+        return None
+
+    def open(self,sha):
+        """ returns (type,size,blocks) for an object, blocks being a generator for its data, or None if it
+        isn't in the objects dir """
+        return self.lookup(sha,self.openPacked,self.openLoose)
+
+    def info(self,sha):
+        """ returns (type,size) for an object, or None if it isn't in the objects dir. only its header is read,
+        and for a delta the headers of the chain and the start of the delta, as with git cat-file -s """
+        return self.lookup(sha,self.packedInfo,self.looseInfo)
+
+    def lookup(self,sha,packed,loose):
+        """ returns packed(pack,offset) for an object in a pack, otherwise loose(sha), which returns None if
+        there is no such loose object """
+        if not isSha(sha):
+            raise Unsupported("'%s' isn't a sha"%sha)
+        binsha=binascii.unhexlify(sha)
+        found=self.find(binsha)
+        if found:
+            return packed(*found)
+        result=loose(sha)
+        if result:
+            return result
+        # it might have been packed since the packs were scanned
+        if self.scanPacks():
+            found=self.find(binsha)
+            if found:
+                return packed(*found)
+        return None
+
+    def looseInfo(self,sha):
+        try:
+            f=open(os.path.join(self.objects,sha[:2],sha[2:]),'rb')
+        except (IOError,OSError):
+            return None
+        try:
+            header=zlib.decompressobj().decompress(f.read(256),64)
+            if b'\0' not in header:
+                raise ValueError('no end to the header')
+            (kind,size)=header.split(b'\0',1)[0].decode('ascii').split(' ')
+            return (kind,int(size))
+        except (zlib.error,ValueError,UnicodeError):
+            raise Unsupported('loose object %s has a bad header'%sha)
+        finally:
+            f.close()
+
+    def packedInfo(self,pack,offset):
+        (kind,size,pos,base)=pack.header(offset)
+        if kind in typeNames:
+            return (typeNames[kind],size)
+        size=pack.deltaResultSize(pos)
+        # the type is that of the object at the end of the chain
+        while kind not in typeNames:
+            if kind==refDelta:
+                found=self.find(base)
+                if not found:
+                    raise Unsupported('delta base %s is not in a pack'%binascii.hexlify(base))
+                (pack,offset)=found
+            else:
+                offset=base
+            (kind,baseSize,pos,base)=pack.header(offset)
+        return (typeNames[kind],size)
+
+    def openLoose(self,sha):
+        try:
+            f=open(os.path.join(self.objects,sha[:2],sha[2:]),'rb')
+        except (IOError,OSError):
+            return None
+        blocks=inflate(iter(lambda : f.read(readSize),b''))
+        data=b''
+        while b'\0' not in data and len(data)<64:
+            block=next(blocks,None)
+            if block is None:
+                break
+            data+=block
+        try:
+            (header,data)=data.split(b'\0',1)
+            (kind,size)=header.decode('ascii').split(' ')
+            size=int(size)
+        except ValueError:
+            f.close()
+            raise Unsupported('loose object %s has a bad header'%sha)
+        def rest():
+            try:
+                if data:
+                    yield data
+                for block in blocks:
+                    yield block
+            finally:
+                f.close()
+        return (kind,size,rest())
+
+    def openPacked(self,pack,offset):
+        (kind,size,pos,base)=pack.header(offset)
+        if kind in typeNames and (pack,offset) not in self.cache:
+            # not a delta, so it can be inflated as it is read
+            return (typeNames[kind],size,pack.inflate(pos,size))
+        (kind,data)=self.readPacked(pack,offset)
+        return (kind,len(data),iter([data]))
+
+    def readPacked(self,pack,offset):
+        """ returns (type,data) for the object at offset in pack, resolving any deltas """
+        # follow the chain of deltas back to an object that is cached or isn't a delta
+        deltas=[]
+        while True:
+            if (pack,offset) in self.cache:
+                (kind,data)=self.recall((pack,offset))
+                break
+            (kind,size,pos,base)=pack.header(offset)
+            if kind in typeNames:
+                (kind,data)=(typeNames[kind],b''.join(pack.inflate(pos,size)))
+                self.remember((pack,offset),(kind,data))
+                break
+            deltas.append((pack,offset,bytearray(b''.join(pack.inflate(pos,size)))))
+            if kind==refDelta:
+                found=self.find(base)
+                if not found:
+                    # a thin pack's base can be loose
+                    raise Unsupported('delta base %s is not in a pack'%binascii.hexlify(base))
+                (pack,offset)=found
+            else:
+                offset=base
+        for (pack,offset,delta) in reversed(deltas):
+            data=applyDelta(data,delta)
+            self.remember((pack,offset),(kind,data))
+        return (kind,data)
+
+    def recall(self,key):
+        value=self.cache.pop(key)
+        self.cache[key]=value
+        return value
+
+    def remember(self,key,value):
+        """ caches a resolved object, dropping the least recently used ones to stay in the cache size """
+        if len(value[1])>self.cacheSize//4:
+            # it would push out too much
+            return
+        self.cache[key]=value
+        self.cached+=len(value[1])
+        while self.cached>self.cacheSize and len(self.cache)>1:
+            (old,(kind,data))=self.cache.popitem(last=False)
+            self.cached-=len(data)
+
+def readLooseRef(path):
+    f=open(path,'rb')
+    try:
+        value=f.read().decode('ascii','replace').strip()
+    finally:
+        f.close()
+    if not isSha(value):
+        raise Unsupported('%s is a symbolic ref or not a ref at all'%path)
+    return value
+
+badRefChars=re.compile(r'[\x00-\x20\x7f~^:?*\[\\]|\.\.|@\{|/\.|\.lock(/|$)').search
+
+def checkRefPrefix(prefix):
+    """ raises Unsupported unless prefix is a ref name under refs/, or one with / on the end for the refs in
+    a dir, that git check-ref-format would allow. anything else is left to git, which is the judge of what
+    it will resolve, and so can never lead outside refs/ """
+    name=prefix[:-1] if prefix.endswith('/') else prefix
+    if not (name+'/').startswith('refs/') or name.endswith('.') or '//' in name or badRefChars(name):
+        raise Unsupported("'%s' isn't a ref name that can be looked up here"%prefix)
+
+def lineStart(data,pos,start):
+    """ returns where the line pos is in begins, not looking back before start """
+    return data.rfind(b'\n',start,pos)+1 or start
+
+def packedRecord(data,pos):
+    """ returns (sha,ref name,start of the next record) for the record of packed-refs starting at pos,
+    skipping the peeled line that can follow it """
+    end=data.find(b'\n',pos)
+    if end<0:
+        end=len(data)
+    line=data[pos:end]
+    pos=end+1
+    if data[pos:pos+1]==b'^':
+        end=data.find(b'\n',pos)
+        pos=len(data) if end<0 else end+1
+    return (line[:40].decode('ascii'),line[41:].rstrip(b'\r'),pos)
+
+def readPackedRefs(gitdir,prefix,dirPrefix):
+    """ returns a dict of sha keyed by ref name for the refs in packed-refs that are prefix or in dirPrefix
+    a sorted packed-refs is searched with a binary search and only the records wanted are decoded """
+    refs={}
+    try:
+        f=open(os.path.join(gitdir,'packed-refs'),'rb')
+    except IOError:
+        return refs
+    try:
+        if not os.fstat(f.fileno()).st_size:
+            return refs
+        data=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    try:
+        start=0
+        sort=False
+        if data[:1]==b'#':
+            start=data.find(b'\n')+1 or len(data)
+            sort=b' sorted' in data[:start]
+        key=prefix.encode('utf8')
+        dirKey=dirPrefix.encode('utf8')
+        pos=start
+        if sort:
+            # the first record not before prefix, as git's own lookup finds it
+            hi=len(data)
+            while pos<hi:
+                mid=lineStart(data,(pos+hi)//2,pos)
+                if data[mid:mid+1]==b'^':
+                    mid=lineStart(data,mid-1,pos)
+                (sha,ref,after)=packedRecord(data,mid)
+                if ref<key:
+                    pos=after
+                else:
+                    hi=mid
+        while pos<len(data):
+            if data[pos:pos+1]==b'^':
+                pos=data.find(b'\n',pos)+1 or len(data)
+                continue
+            (sha,ref,pos)=packedRecord(data,pos)
+            if ref==key or ref.startswith(dirKey):
+                refs[ref.decode('utf8','replace')]=sha
+            elif sort and ref>dirKey:
+                break
+    finally:
+        data.close()
+    return refs
+
+def readRefs(gitdir,prefix):
+    """ returns a dict of sha keyed by ref name for the refs prefix picks out, as with for-each-ref: the
+    ref prefix itself and those in the dir prefix """
+    checkRefPrefix(prefix)
+    dirPrefix=prefix.rstrip('/')+'/'
+    refs={}
+    # the loose refs are read first. a ref being packed is written to packed-refs before its file goes,
+    # and one being deleted goes from packed-refs before its file does, so it is never missed
+    top=os.path.join(gitdir,*prefix.rstrip('/').split('/'))
+    refsDir=os.path.realpath(os.path.join(gitdir,'refs'))
+    real=os.path.realpath(top)
+    if real!=refsDir and not real.startswith(refsDir+os.sep):
+        raise Unsupported("'%s' leads outside of refs/"%prefix)
+    if not prefix.endswith('/') and os.path.isfile(top):
+        refs[prefix]=readLooseRef(top)
+    for (dir,subdirs,files) in os.walk(top):
+        for name in files:
+            if name.endswith('.lock'):
+                continue
+            path=os.path.join(dir,name)
+            ref=os.path.relpath(path,gitdir).replace(os.sep,'/')
+            refs[ref]=readLooseRef(path)
+    for (ref,sha) in readPackedRefs(gitdir,prefix,dirPrefix).items():
+        refs.setdefault(ref,sha)
+    return refs
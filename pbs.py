@@ -27,6 +27,10 @@ import sys
 import traceback
 import os
 import re
+import threading
+import time
+try: import fcntl
+except ImportError: fcntl = None
 from glob import glob as original_glob
 from types import ModuleType
 from functools import partial
@@ -105,7 +109,29 @@ def which(program):
 
     return None
 
+# resolved program paths and the Command objects made from them.  looking a
+# program up means scanning every PATH entry, so we only do it once for each
+# program, and start again if PATH is changed
+_resolve_cache = {}
+_command_cache = {}
+_cached_path = [None]
+
+def _check_resolve_cache():
+    path = os.environ.get("PATH")
+    if path != _cached_path[0]:
+        clear_resolve_cache()
+        _cached_path[0] = path
+
+def clear_resolve_cache():
+    _resolve_cache.clear()
+    _command_cache.clear()
+    _cached_path[0] = None
+
 def resolve_program(program):
+    _check_resolve_cache()
+    try: return _resolve_cache[program]
+    except KeyError: pass
+
     path = which(program)
     if not path:
         # our actual command might have a dash in it, but we can't call
@@ -113,7 +139,9 @@ def resolve_program(program):
         # if a dash version of our underscore command exists and use that
         # if it does
         if "_" in program: path = which(program.replace("_", "-"))
+        # don't remember misses, the program might be installed later
         if not path: return None
+    _resolve_cache[program] = path
     return path
 
 
@@ -121,27 +149,155 @@ def glob(arg):
     return original_glob(arg) or arg
 
 
+# python 2 makes its pipes inheritable, so a process started from one thread
+# can end up holding the pipes of a process started from another, and the
+# other process then never sees its input end.  so processes are only started
+# one at a time, and our ends of their pipes are closed on exec before the
+# next one can start
+_popen_lock = threading.Lock()
+
+def _popen(*args, **kwargs):
+    with _popen_lock:
+        started = time.time()
+        process = subp.Popen(*args, **kwargs)
+        # for _trace, once the process is finished
+        process._pbs_argv = list(args[0])
+        process._pbs_started = started
+        if fcntl:
+            for pipe in (process.stdin, process.stdout, process.stderr):
+                if pipe is None: continue
+                flags = fcntl.fcntl(pipe, fcntl.F_GETFD)
+                fcntl.fcntl(pipe, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    return process
+
+# functions called with a record of each process that pbs runs, once it has
+# finished.  see add_trace_hook
+_trace_hooks = []
+
+def add_trace_hook(fn):
+    """ has fn(record) called for every process pbs runs from now on, once
+    the process has finished and been waited for.  record is a dict of:
+        argv        the command line, a list
+        pid
+        start       when it was started, as a time.time()
+        wall        seconds from starting it until it was waited for
+        exit_code
+        bytes_in    how much pbs wrote to its stdin
+        bytes_out   how much pbs read from its stdout
+        bytes_err   how much pbs read from its stderr
+    data that goes straight between the process and a file or another process
+    doesn't pass through pbs, so isn't counted.  the hook is called from
+    whichever thread waited for the process """
+    _trace_hooks.append(fn)
+
+def remove_trace_hook(fn):
+    _trace_hooks.remove(fn)
+
+def _trace(process, io):
+    # tells the hooks about a process that has finished, only once
+    started, process._pbs_started = process._pbs_started, None
+    if started is None or not _trace_hooks: return
+    record = {"argv": process._pbs_argv, "pid": process.pid,
+        "start": started, "wall": time.time() - started,
+        "exit_code": process.returncode, "bytes_in": io["in"],
+        "bytes_out": io["out"], "bytes_err": io["err"]}
+    for hook in list(_trace_hooks): hook(record)
+
+def _io_counts():
+    # the bytes that have gone through pbs to and from a process
+    return {"in": 0, "out": 0, "err": 0}
+
+def _start_thread(fn, *args):
+    thread = threading.Thread(target=fn, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def _fileno(obj):
+    # the file descriptor of a real file, None for anything else
+    try: return obj.fileno()
+    except Exception: return None
+
+def _is_stream(data):
+    # an _in that is written as it is read rather than all at once
+    return data is not None and not isinstance(data, (bytes, unicode))
+
+def _read_blocks(f):
+    for block in iter(lambda: f.read(65536), f.read(0)): yield block
+
+def _stdin_chunks(data):
+    # _in can be a string, a file-like object or any iterable of strings.
+    # bytes are written as they are, text as utf8
+    if not _is_stream(data): chunks = [data] if data else []
+    elif hasattr(data, "read"): chunks = _read_blocks(data)
+    else: chunks = data
+    for chunk in chunks:
+        if isinstance(chunk, unicode): chunk = chunk.encode("utf8")
+        yield chunk
+
+def _feed_stdin(pipe, data, io):
+    try:
+        for chunk in _stdin_chunks(data):
+            pipe.write(chunk)
+            io["in"] += len(chunk)
+    except (IOError, OSError): pass # the process stopped reading
+    finally:
+        try: pipe.close()
+        except (IOError, OSError): pass
+
+def _drain(pipe, chunks):
+    for chunk in iter(lambda: pipe.read(4096), b""): chunks.append(chunk)
+    pipe.close()
+
+
 
 
 class RunningCommand(object):
-    def __init__(self, command_ran, process, call_args, stdin=None):
+    def __init__(self, command_ran, process, call_args, stdin=None,
+            upstream=None):
         self.command_ran = command_ran
         self.process = process
         self._stdout = None
         self._stderr = None
+        self._stderr_thread = None
+        self._io = _io_counts()
         self.call_args = call_args
+        # a command piped into this one, its exit code is checked along with
+        # ours
+        self._upstream = upstream
+
+        # we're running this command as a with context, don't do anything
+        # because nothing was started to run from Command.__call__
+        if self.call_args["with"]: return
+
+        # the input is fed from a thread when it has to be read as it goes,
+        # or when we aren't going to sit in communicate() to write it
+        if self.process.stdin and (_is_stream(stdin) or self.call_args["bg"]
+                or self.call_args["iter"] or self.call_args["piped"]):
+            pipe, self.process.stdin = self.process.stdin, None
+            _start_thread(_feed_stdin, pipe, stdin, self._io)
+            stdin = None
+        elif isinstance(stdin, unicode): stdin = stdin.encode("utf8")
+        if stdin and self.process.stdin: self._io["in"] = len(stdin)
 
         # we're running in the background, return self and let us lazily
         # evaluate
         if self.call_args["bg"]: return
 
-        # we're running this command as a with context, don't do anything
-        # because nothing was started to run from Command.__call__
-        if self.call_args["with"]: return
+        # we're going to be iterated over, or our output is going straight
+        # into another process.  stderr is looked after by a thread, so that
+        # the process can't block on it while its output is being read
+        if self.call_args["iter"] or self.call_args["piped"]:
+            if self.call_args["iter"]: self._stdout = b""
+            if self.process.stderr:
+                pipe, self.process.stderr = self.process.stderr, None
+                self._stderr_chunks = []
+                self._stderr_thread = _start_thread(_drain,
+                    pipe, self._stderr_chunks)
+            return
 
         # run and block
-        if stdin: stdin = stdin.encode("utf8")
-        self._stdout, self._stderr = self.process.communicate(stdin)
+        self._communicate(stdin)
         self._handle_exit_code(self.process.wait())
 
     def __enter__(self):
@@ -161,7 +317,7 @@ class RunningCommand(object):
 
     def __unicode__(self):
         if self.process:
-            if self.call_args["bg"]: self.wait()
+            if self.call_args["bg"] or self.call_args["piped"]: self.wait()
             if self._stdout: return self.stdout
             else: return ""
 
@@ -171,6 +327,44 @@ class RunningCommand(object):
     def __contains__(self, item):
         return item in str(self)
 
+    def __iter__(self):
+        if not self.call_args["iter"]:
+            return iter(str(self).splitlines(True))
+        return self._iter_lines()
+
+    def _iter_lines(self):
+        # yields each line of output (as a native string, like str() gives)
+        # as soon as the process writes it, then checks the exit code once
+        # the output is finished.  lines aren't kept, so str() of an _iter
+        # command is always empty
+        finished = False
+        try:
+            for line in iter(self.process.stdout.readline, b""):
+                self._io["out"] += len(line)
+                if IS_PY3: line = line.decode("utf8", "replace")
+                yield line
+            finished = True
+        finally:
+            # we were abandoned part way through, don't leave the process
+            # hanging around
+            if not finished and self.process.returncode is None:
+                self.process.kill()
+            self.process.stdout.close()
+            rc = self.process.wait()
+            self._finish_stderr()
+        self._handle_exit_code(rc)
+
+    def _finish_stderr(self):
+        if self._stderr_thread:
+            self._stderr_thread.join()
+            self._stderr = b"".join(self._stderr_chunks)
+            self._io["err"] = len(self._stderr)
+
+    def _communicate(self, stdin=None):
+        self._stdout, self._stderr = self.process.communicate(stdin)
+        self._io["out"] = len(self._stdout or b"")
+        self._io["err"] = len(self._stderr or b"")
+
     def __getattr__(self, p):
         # let these three attributes pass through to the Popen object
         if p in ("send_signal", "terminate", "kill"):
@@ -193,21 +387,40 @@ class RunningCommand(object):
 
     @property
     def stdout(self):
-        if self.call_args["bg"]: self.wait()
+        if self.call_args["bg"] or self.call_args["piped"]: self.wait()
         return self._stdout.decode("utf8", "replace")
 
     @property
     def stderr(self):
-        if self.call_args["bg"]: self.wait()
+        if self.call_args["bg"] or self.call_args["piped"]: self.wait()
         return self._stderr.decode("utf8", "replace")
 
     def wait(self):
         if self.process.returncode is not None: return
-        self._stdout, self._stderr = self.process.communicate()
+        if self.call_args["iter"]:
+            for line in self: pass
+            return str(self)
+        if self.call_args["piped"]:
+            # whatever didn't go to another process is ours
+            self._stdout = b""
+            if self.process.stdout:
+                self._stdout = self.process.stdout.read()
+                self._io["out"] = len(self._stdout)
+                self.process.stdout.close()
+            rc = self.process.wait()
+            self._finish_stderr()
+            self._handle_exit_code(rc)
+            return str(self)
+        self._communicate()
         self._handle_exit_code(self.process.wait())
         return str(self)
 
     def _handle_exit_code(self, rc):
+        # like a shell with pipefail, a failed command earlier in the pipe
+        # is what gets reported
+        upstream, self._upstream = self._upstream, None
+        if upstream is not None: upstream.wait()
+        _trace(self.process, self._io)
         if rc not in self.call_args["ok_code"]:
             raise get_rc_exc(rc)(self.command_ran, self._stdout, self._stderr)
 
@@ -217,17 +430,142 @@ class RunningCommand(object):
 
 
 
+class CoProcess(object):
+    """ a process that is kept running so that it can be sent many requests,
+    for programs with a batch protocol.  requests are written to its stdin and
+    the answers read back from its stdout, both as bytes.  its stderr is
+    collected in the background so it can never block on it.  closing it (or
+    leaving a with block) ends its input, waits for it to exit and raises the
+    usual ErrorReturnCode if its exit code wasn't ok """
+
+    def __init__(self, command_ran, process, call_args):
+        self.command_ran = command_ran
+        self.process = process
+        self.call_args = call_args
+        self._stderr = None
+        self._stderr_chunks = []
+        self._stderr_thread = None
+        self._io = _io_counts()
+        if self.process.stderr:
+            pipe, self.process.stderr = self.process.stderr, None
+            self._stderr_thread = _start_thread(_drain,
+                pipe, self._stderr_chunks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        # if the block failed, don't hide why by complaining about how the
+        # process ended
+        if typ: self.kill()
+        else: self.close()
+
+    def __repr__(self):
+        return "<CoProcess %r, pid:%d>" % (self.command_ran, self.process.pid)
+
+    def write(self, data):
+        if isinstance(data, unicode): data = data.encode("utf8")
+        try: self.process.stdin.write(data)
+        except (IOError, OSError):
+            # it's gone, find out why
+            self.close()
+            raise
+        self._io["in"] += len(data)
+
+    def flush(self):
+        try: self.process.stdin.flush()
+        except (IOError, OSError):
+            self.close()
+            raise
+
+    def writeline(self, line):
+        """ writes a request line and makes sure it has been sent """
+        self.write(line)
+        self.write(b"\n")
+        self.flush()
+
+    def readline(self):
+        """ reads one line of the answer, without its newline """
+        line = self.process.stdout.readline()
+        self._io["out"] += len(line)
+        if not line.endswith(b"\n"): self._died()
+        return line[:-1]
+
+    def read(self, size):
+        """ reads exactly size bytes of the answer """
+        data = self.process.stdout.read(size)
+        self._io["out"] += len(data)
+        if len(data) != size: self._died()
+        return data
+
+    def request(self, line):
+        """ sends a request line and returns the first line of the answer """
+        self.writeline(line)
+        return self.readline()
+
+    def _died(self):
+        # the answer stopped short, which only happens if the process ended.
+        # if it claims it ended ok we still have to complain
+        self.close()
+        raise get_rc_exc(self.process.returncode)(self.command_ran, None,
+            self._stderr)
+
+    def close(self):
+        """ ends the input, waits for the process to exit and checks how it
+        did.  anything it writes that wasn't read is thrown away """
+        if self.process.returncode is not None: return
+        try: self.process.stdin.close()
+        except (IOError, OSError): pass
+        for chunk in iter(lambda: self.process.stdout.read(4096), b""):
+            self._io["out"] += len(chunk)
+        self.process.stdout.close()
+        rc = self.process.wait()
+        self._finish_stderr()
+        _trace(self.process, self._io)
+        if rc not in self.call_args["ok_code"]:
+            raise get_rc_exc(rc)(self.command_ran, None, self._stderr)
+
+    def kill(self):
+        """ stops the process without checking how it ended """
+        if self.process.returncode is not None: return
+        self.process.kill()
+        for pipe in (self.process.stdin, self.process.stdout):
+            try: pipe.close()
+            except (IOError, OSError): pass
+        self.process.wait()
+        self._finish_stderr()
+        _trace(self.process, self._io)
+
+    def _finish_stderr(self):
+        if self._stderr_thread:
+            self._stderr_thread.join()
+            self._stderr = b"".join(self._stderr_chunks)
+            self._io["err"] = len(self._stderr)
+
+    @property
+    def stderr(self):
+        if self._stderr is None: return None
+        return self._stderr.decode("utf8", "replace")
+
+
+
+
 class Command(object):
     _prepend_stack = []
 
     call_args = {
         "fg": False, # run command in foreground
         "bg": False, # run command in background
+        "iter": False, # iterate over the lines of STDOUT as they come
+        "piped": False, # STDOUT goes through an OS pipe to the command this
+                        # is passed to
+
+        "coproc": False, # keep the process running to talk to (CoProcess)
         "with": False, # prepend the command to every command after it
         "out": None, # redirect STDOUT
         "err": None, # redirect STDERR
         "err_to_out": None, # redirect STDERR to STDOUT
-        "in": None,
+        "in": None, # a string, file, or iterable of strings for STDIN
         "env": os.environ,
         "cwd": None,
 
@@ -238,9 +576,17 @@ class Command(object):
 
     @classmethod
     def _create(cls, program):
+        # Commands aren't changed by calling or baking them, so one can be
+        # shared by everyone who looks the same program up
+        _check_resolve_cache()
+        try: return _command_cache[(cls, program)]
+        except KeyError: pass
+
         path = resolve_program(program)
         if not path: raise CommandNotFound(program)
-        return cls(path)
+        cmd = cls(path)
+        _command_cache[(cls, program)] = cmd
+        return cmd
 
     def __init__(self, path):
         self._path = path
@@ -374,6 +720,7 @@ If you're using glob.glob(), please use pbs.glob() instead." % self.path, stackl
         # check if we're piping via composition
         stdin = pipe
         actual_stdin = None
+        upstream = None
         if args:
             first_arg = args.pop(0)
             if isinstance(first_arg, RunningCommand):
@@ -382,9 +729,14 @@ If you're using glob.glob(), please use pbs.glob() instead." % self.path, stackl
                 # background as well
                 if first_arg.call_args["bg"]:
                     call_args["bg"] = True
+                # a command that is still running hands its output straight
+                # over through its pipe, otherwise we get the bytes it wrote
+                if (first_arg.call_args["bg"] or first_arg.call_args["piped"]) \
+                        and first_arg.process.stdout:
                     stdin = first_arg.process.stdout
+                    upstream = first_arg
                 else:
-                    actual_stdin = first_arg.stdout
+                    actual_stdin = first_arg._stdout
             else: args.insert(0, first_arg)
 
         processed_args = self._compile_args(args, kwargs)
@@ -404,10 +756,12 @@ If you're using glob.glob(), please use pbs.glob() instead." % self.path, stackl
             return RunningCommand(command_ran, None, call_args)
 
 
-        # stdin from string
+        # stdin from string, or from a real file, which is handed straight to
+        # the process so the data never passes through python
         input = call_args["in"]
         if input:
-            actual_stdin = input
+            if _fileno(input) is not None: stdin = input
+            else: actual_stdin = input
 
         # stdout redirection
         stdout = pipe
@@ -426,11 +780,27 @@ If you're using glob.glob(), please use pbs.glob() instead." % self.path, stackl
 
         if call_args["err_to_out"]: stderr = subp.STDOUT
 
-        # leave shell=False
-        process = subp.Popen(cmd, shell=False, env=call_args["env"],
-            cwd=call_args["cwd"], stdin=stdin, stdout=stdout, stderr=stderr)
+        if call_args["coproc"]: stdin = stdout = subp.PIPE
 
-        return RunningCommand(command_ran, process, call_args, actual_stdin)
+        # output read a line at a time needs buffering, otherwise (on python
+        # 2) every byte is a separate read
+        bufsize = -1 if call_args["coproc"] or call_args["iter"] else 0
+
+        # leave shell=False
+        process = _popen(cmd, shell=False, env=call_args["env"],
+            cwd=call_args["cwd"], stdin=stdin, stdout=stdout, stderr=stderr,
+            bufsize=bufsize)
+
+        if upstream is not None:
+            # the pipe is the new process's now, if we kept our end the
+            # upstream process couldn't tell when it had stopped reading
+            upstream.process.stdout.close()
+            upstream.process.stdout = None
+
+        if call_args["coproc"]:
+            return CoProcess(command_ran, process, call_args)
+        return RunningCommand(command_ran, process, call_args, actual_stdin,
+            upstream)
 
 
 
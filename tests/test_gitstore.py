@@ -0,0 +1,186 @@
+# test_gitstore.py
+# Checks that gitstore reads the same objects and refs as git does, on repros made by git with deltified
+# packs (ofs- and ref-deltas, 64 bit offsets), loose objects and packed refs
+#
+# usage: python -m unittest discover tests (or pytest tests)
+
+import os,sys,shutil,random,tempfile,unittest,subprocess
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import gitstore
+
+def git(repo,*args,**kwargs):
+    env=dict(os.environ,GIT_AUTHOR_NAME='gib',GIT_AUTHOR_EMAIL='gib@example.com',
+        GIT_COMMITTER_NAME='gib',GIT_COMMITTER_EMAIL='gib@example.com')
+    proc=subprocess.Popen(('git',)+args,cwd=repo,env=env,stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+    (out,err)=proc.communicate(kwargs.get('input'))
+    if proc.returncode:
+        raise AssertionError('git %s failed'%' '.join(args))
+    return out
+
+def makeRepro(path):
+    """ makes a repro with a history of small edits to a few files, so packing them makes long delta chains """
+    git(os.path.dirname(path),'init','-q',path)
+    rng=random.Random(path)
+    lines=dict((name,['%s line %d %s\n'%(name,i,'x'*rng.randint(0,80)) for i in range(400)]) for name in 'abc')
+    for version in range(60):
+        for (name,text) in lines.items():
+            for n in range(rng.randint(1,5)):
+                text[rng.randrange(len(text))]='%s edit %d %d\n'%(name,version,n)
+            with open(os.path.join(path,name),'w') as f:
+                f.write(''.join(text))
+        git(path,'add','-A')
+        git(path,'commit','-q','-m','version %d'%version)
+    git(path,'tag','-a','-m','a tag','v1','HEAD~10')
+    return path
+
+def allObjects(repo):
+    return git(repo,'cat-file','--batch-all-objects','--batch-check=%(objectname)').decode('ascii').split()
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.mkdtemp(prefix='test_gitstore.')
+        self.repo=makeRepro(os.path.join(self.dir,'repo'))
+        self.gitdir=os.path.join(self.repo,'.git')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def repack(self,*options):
+        """ packs every object into one pack with pack-objects options, dropping the loose objects """
+        pack=os.path.join(self.gitdir,'objects','pack')
+        for name in os.listdir(pack):
+            os.remove(os.path.join(pack,name))
+        names=git(self.repo,'cat-file','--batch-all-objects','--batch-check=%(objectname)')
+        git(self.repo,'pack-objects','-q','--window=50','--depth=200',*options+(os.path.join(pack,'pack'),),
+            input=names)
+        git(self.repo,'prune-packed')
+
+    def assertSameAsGit(self,cacheSize=96*1024*1024):
+        shas=allObjects(self.repo)
+        self.assertTrue(shas)
+        store=gitstore.ObjectStore(self.gitdir,cacheSize)
+        try:
+            # sizes come from the headers, without resolving any deltas
+            sizes=dict((sha,store.info(sha)) for sha in shas)
+            self.assertEqual(store.cached,0)
+            for sha in shas:
+                kind=git(self.repo,'cat-file','-t',sha).decode('ascii').strip()
+                data=git(self.repo,'cat-file',kind,sha)
+                found=store.open(sha)
+                self.assertTrue(found,sha)
+                self.assertEqual((found[0],found[1]),(kind,len(data)),sha)
+                self.assertEqual(b''.join(found[2]),data,sha)
+                self.assertEqual(sizes[sha],(kind,len(data)),sha)
+            self.assertEqual(store.open('0'*40),None)
+            self.assertEqual(store.info('0'*40),None)
+            self.assertTrue(store.cached<=cacheSize,(store.cached,cacheSize))
+            self.assertEqual(store.cached,sum(len(data) for (kind,data) in store.cache.values()))
+        finally:
+            store.close()
+
+    def deltas(self):
+        """ returns how many objects in the pack are deltas and the longest chain """
+        pack=os.path.join(self.gitdir,'objects','pack')
+        idx=[name for name in os.listdir(pack) if name.endswith('.idx')][0]
+        out=git(self.repo,'verify-pack','-v',os.path.join(pack,idx)).decode('ascii').splitlines()
+        depths=[int(line.split()[5]) for line in out if len(line.split())==7]
+        return (len(depths),max(depths or [0]))
+
+    def testLoose(self):
+        self.assertSameAsGit()
+
+    def testOfsDeltas(self):
+        self.repack('--delta-base-offset')
+        (count,depth)=self.deltas()
+        self.assertTrue(count>50 and depth>10,(count,depth))
+        self.assertSameAsGit()
+
+    def testRefDeltas(self):
+        self.repack()
+        self.assertTrue(self.deltas()[0]>50)
+        self.assertSameAsGit()
+
+    def testBigOffsets(self):
+        # every object past the first 16 bytes of the pack gets a 64 bit offset in the .idx
+        self.repack('--delta-base-offset','--index-version=2,16')
+        self.assertSameAsGit()
+
+    def testSmallCache(self):
+        # objects keep being dropped from the cache part way through resolving chains
+        self.repack('--delta-base-offset')
+        self.assertSameAsGit(cacheSize=16*1024)
+
+    def testPackedAndLoose(self):
+        self.repack('--delta-base-offset')
+        with open(os.path.join(self.repo,'new'),'w') as f:
+            f.write('new file\n')
+        git(self.repo,'add','new')
+        git(self.repo,'commit','-q','-m','loose')
+        self.assertSameAsGit()
+
+class RefsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.mkdtemp(prefix='test_gitstore.')
+        self.repo=os.path.join(self.dir,'repo')
+        git(self.dir,'init','-q',self.repo)
+        self.gitdir=os.path.join(self.repo,'.git')
+        tree=git(self.repo,'hash-object','-w','-t','tree','/dev/null').decode('ascii').strip()
+        self.commit=git(self.repo,'commit-tree','-m','x',tree).decode('ascii').strip()
+        commands=[]
+        for i in range(500):
+            commands.append('create refs/gib/b%d/snapshots/s%03d %s\n'%(i%7,i,self.commit))
+            commands.append('create refs/gib/b%d-x/snapshots/s%03d %s\n'%(i%3,i,self.commit))
+            commands.append('create refs/tags/t%03d %s\n'%(i,self.commit))
+        git(self.repo,'update-ref','--stdin',input=''.join(commands).encode('ascii'))
+        git(self.repo,'tag','-a','-m','peeled','annotated',self.commit)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def forEachRef(self,prefix):
+        out=git(self.repo,'for-each-ref','--format=%(objectname) %(refname)',prefix).decode('ascii')
+        return dict(line.split(' ',1)[::-1] for line in out.splitlines())
+
+    def assertSameRefs(self):
+        for prefix in ('refs/','refs/gib/','refs/gib/b1/','refs/gib/b1','refs/gib/b1-x/','refs/gib/b6/snapshots/s006',
+                'refs/gib/b0/snapshots/s000','refs/tags/','refs/tags/annotated','refs/tags/t499','refs/none/'):
+            self.assertEqual(gitstore.readRefs(self.gitdir,prefix),self.forEachRef(prefix),prefix)
+
+    def testLoose(self):
+        self.assertSameRefs()
+
+    def testPacked(self):
+        git(self.repo,'pack-refs','--all')
+        self.assertSameRefs()
+
+    def testPackedAndLoose(self):
+        git(self.repo,'pack-refs','--all')
+        git(self.repo,'update-ref','refs/gib/b1/snapshots/s999',self.commit)
+        git(self.repo,'update-ref','-d','refs/gib/b1/snapshots/s001')
+        self.assertSameRefs()
+
+    def testUnsorted(self):
+        git(self.repo,'pack-refs','--all')
+        path=os.path.join(self.gitdir,'packed-refs')
+        with open(path) as f:
+            lines=f.readlines()
+        # each record keeps its peeled line after it
+        records=[]
+        for line in lines[1:]:
+            if line.startswith('^'):
+                records[-1]+=line
+            else:
+                records.append(line)
+        with open(path,'w') as f:
+            f.write('# pack-refs with: peeled\n')
+            f.writelines(reversed(records))
+        self.assertEqual(gitstore.readRefs(self.gitdir,'refs/gib/b2/'),self.forEachRef('refs/gib/b2/'))
+
+    def testBadNames(self):
+        for name in ('refs/gib/b1/snapshots/../../../../config','refs/../config','config','/refs/gib/','refs//gib/',
+                'refs/gib/.b1/','refs/gib/b1.lock/','refs/gib/b1/snapshots/s001\0'):
+            self.assertRaises(gitstore.Unsupported,gitstore.readRefs,self.gitdir,name)
+
+if __name__ == "__main__":
+    unittest.main()